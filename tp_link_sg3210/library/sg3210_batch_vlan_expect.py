@@ -23,13 +23,23 @@ Parameters:
     hostname: CLI prompt hostname (default: SG3210)
     mode: "replace" or "add" (default: add)
     protected_vlans: List of VLAN IDs that are never deleted (default: [1])
+    control_persist: Seconds to keep the SSH connection open for later tasks (default: 0)
+    cache_ttl: Seconds to trust a previously confirmed state without SSH (default: 0 = off)
 """
 
 from ansible.module_utils.basic import AnsibleModule
+import atexit
+import functools
+import hashlib
+import json
+import string
 import subprocess
 import tempfile
+import threading
+import time
 import os
 import re
+import shutil
 
 
 DOCUMENTATION = r'''
@@ -73,6 +83,33 @@ options:
         default: [1]
         type: list
         elements: int
+    control_persist:
+        description:
+            - Seconds to keep the SSH master connection open after the task, so later
+              tasks against the same switch and user reuse it instead of logging in again
+            - 0 closes the connection when the module finishes
+        required: false
+        default: 0
+        type: int
+    cache_ttl:
+        description:
+            - Seconds for which a switch confirmed to match the requested VLANs is trusted
+              without reading its running-config again (cache in ~/.ansible/tp_link_vlan_cache)
+            - Changes made on the switch by other means within this window are not detected
+            - 0 disables the cache
+        required: false
+        default: 0
+        type: int
+requirements:
+    - expect
+    - sshpass
+notes:
+    - The module runs two expect scripts, one to read the running-config and one to
+      apply the calculated diff. The diff (VLAN names, tagged/untagged ports, PVIDs)
+      is computed in Python between the two, so they are not merged into one script.
+    - Both scripts share one multiplexed SSH connection, so the configure phase does not
+      repeat the TCP handshake, key exchange or authentication. It is skipped entirely
+      when the switch already matches the desired state.
 '''
 
 EXAMPLES = r'''
@@ -120,6 +157,21 @@ def get_vlan_id(vlan):
     return None
 
 
+def format_vlan_ranges(vlan_ids):
+    """Format VLAN IDs as a CLI vlan-list, e.g. [2, 3, 4, 7] -> 2-4,7"""
+    ids = sorted(set(vlan_ids))
+    ranges = []
+    start = prev = ids[0]
+    for vlan_id in ids[1:] + [None]:
+        if vlan_id is not None and vlan_id == prev + 1:
+            prev = vlan_id
+            continue
+        ranges.append(str(start) if start == prev else f"{start}-{prev}")
+        if vlan_id is not None:
+            start = prev = vlan_id
+    return ",".join(ranges)
+
+
 def normalize_vlans(vlans):
     """Normalize VLAN list to use consistent 'id' field internally"""
     normalized = []
@@ -178,6 +230,20 @@ def validate_vlans(module, vlans, protected_vlans, max_port=10):
 # IDEMPOTENCY FUNCTIONS - Parse current config and calculate diff
 # =============================================================================
 
+# One pass over the raw 'show running-config' buffer, one alternative per line type
+RUNNING_CONFIG_LINE_RE = re.compile(
+    r'^[ \t]*(?:'
+    r'vlan[ \t]+(?P<vlan>\d+)[ \t\r]*$'
+    r'|name[ \t]+"(?P<name>[^"\r\n]*)"'
+    r'|interface[ \t]+gigabitEthernet[ \t]+1/0/(?P<port>\d+)'
+    r'|switchport general allowed vlan[ \t]+(?P<allowed>[\d,]+)[ \t]+(?P<allowed_mode>tagged|untagged)'
+    r'|switchport pvid[ \t]+(?P<pvid>\d+)'
+    r'|(?P<boundary>#|end[ \t\r]*$)'
+    r')',
+    re.MULTILINE
+)
+
+
 def parse_running_config(output, max_port=10):
     """
     Parse 'show running-config' output to extract current VLAN and port configuration.
@@ -191,78 +257,59 @@ def parse_running_config(output, max_port=10):
         'vlans': {},
     }
     
-    # VLAN 1 always exists implicitly
-    config['vlans'][1] = {'name': 'System-VLAN', 'tagged_ports': [], 'untagged_ports': []}
+    # VLAN 1 always exists implicitly (port sets become sorted lists at the end)
+    config['vlans'][1] = {'name': 'System-VLAN', 'tagged_ports': set(), 'untagged_ports': set()}
     
     current_vlan_id = None
     current_port = None
     
-    lines = output.split('\n')
-    
-    for line in lines:
-        line_stripped = line.strip()
-        
+    for match in RUNNING_CONFIG_LINE_RE.finditer(output):
         # Parse VLAN definitions: "vlan 10"
-        vlan_def_match = re.match(r'^vlan\s+(\d+)\s*$', line_stripped)
-        if vlan_def_match:
-            current_vlan_id = int(vlan_def_match.group(1))
+        if match.group('vlan') is not None:
+            current_vlan_id = int(match.group('vlan'))
             if current_vlan_id not in config['vlans']:
-                config['vlans'][current_vlan_id] = {'name': '', 'tagged_ports': [], 'untagged_ports': []}
+                config['vlans'][current_vlan_id] = {'name': '', 'tagged_ports': set(), 'untagged_ports': set()}
             current_port = None
-            continue
         
         # Parse VLAN name: 'name "Management"'
-        name_match = re.match(r'^name\s+"([^"]*)"', line_stripped)
-        if name_match and current_vlan_id is not None:
-            config['vlans'][current_vlan_id]['name'] = name_match.group(1)
-            continue
+        elif match.group('name') is not None:
+            if current_vlan_id is not None:
+                config['vlans'][current_vlan_id]['name'] = match.group('name')
         
         # Parse interface: "interface gigabitEthernet 1/0/1"
-        interface_match = re.match(r'^interface\s+gigabitEthernet\s+1/0/(\d+)', line_stripped)
-        if interface_match:
-            current_port = int(interface_match.group(1))
+        elif match.group('port') is not None:
+            current_port = int(match.group('port'))
             current_vlan_id = None  # Reset VLAN context when entering interface
-            continue
         
         # Parse switchport general allowed vlan X,Y tagged/untagged
         # Format: "switchport general allowed vlan 10,22 tagged"
-        # Format: "switchport general allowed vlan 10 untagged"
-        if current_port and line_stripped.startswith('switchport general allowed vlan'):
-            vlan_match = re.match(r'switchport general allowed vlan\s+([\d,]+)\s+(tagged|untagged)', line_stripped)
-            if vlan_match:
-                vlan_list_str = vlan_match.group(1)
-                mode = vlan_match.group(2)
-                
-                # Parse comma-separated VLAN list
-                vlan_ids = [int(v.strip()) for v in vlan_list_str.split(',') if v.strip()]
+        elif match.group('allowed') is not None:
+            if not current_port:
+                continue
+            mode = match.group('allowed_mode')
+            vlan_ids = [int(v) for v in match.group('allowed').split(',') if v]
+            
+            for vid in vlan_ids:
+                if vid not in config['vlans']:
+                    config['vlans'][vid] = {'name': '', 'tagged_ports': set(), 'untagged_ports': set()}
                 
-                for vid in vlan_ids:
-                    # Ensure VLAN exists in our config
-                    if vid not in config['vlans']:
-                        config['vlans'][vid] = {'name': '', 'tagged_ports': [], 'untagged_ports': []}
-                    
-                    if mode == 'tagged':
-                        if current_port not in config['vlans'][vid]['tagged_ports']:
-                            config['vlans'][vid]['tagged_ports'].append(current_port)
-                    else:  # untagged
-                        if current_port not in config['vlans'][vid]['untagged_ports']:
-                            config['vlans'][vid]['untagged_ports'].append(current_port)
-            continue
+                if mode == 'tagged':
+                    config['vlans'][vid]['tagged_ports'].add(current_port)
+                else:  # untagged
+                    config['vlans'][vid]['untagged_ports'].add(current_port)
         
         # Parse PVID: "switchport pvid 10"
         # PVID indicates the port is untagged member of that VLAN
-        pvid_match = re.match(r'switchport pvid\s+(\d+)', line_stripped)
-        if pvid_match and current_port:
-            pvid = int(pvid_match.group(1))
+        elif match.group('pvid') is not None:
+            if not current_port:
+                continue
+            pvid = int(match.group('pvid'))
             if pvid not in config['vlans']:
-                config['vlans'][pvid] = {'name': '', 'tagged_ports': [], 'untagged_ports': []}
-            # PVID means this port is untagged in this VLAN (if not already added)
-            if current_port not in config['vlans'][pvid]['untagged_ports']:
-                config['vlans'][pvid]['untagged_ports'].append(current_port)
-            continue
+                config['vlans'][pvid] = {'name': '', 'tagged_ports': set(), 'untagged_ports': set()}
+            config['vlans'][pvid]['untagged_ports'].add(current_port)
         
         # Reset context on section boundaries
-        if line_stripped.startswith('#') or line_stripped == 'end':
+        else:
             current_port = None
             current_vlan_id = None
     
@@ -275,12 +322,12 @@ def parse_running_config(output, max_port=10):
     
     for port in range(1, max_port + 1):
         if port not in configured_ports:
-            config['vlans'][1]['untagged_ports'].append(port)
+            config['vlans'][1]['untagged_ports'].add(port)
     
     # Sort port lists for consistent comparison
     for vid in config['vlans']:
-        config['vlans'][vid]['tagged_ports'] = sorted(set(config['vlans'][vid]['tagged_ports']))
-        config['vlans'][vid]['untagged_ports'] = sorted(set(config['vlans'][vid]['untagged_ports']))
+        config['vlans'][vid]['tagged_ports'] = sorted(config['vlans'][vid]['tagged_ports'])
+        config['vlans'][vid]['untagged_ports'] = sorted(config['vlans'][vid]['untagged_ports'])
     
     return config
 
@@ -290,11 +337,13 @@ def calculate_diff(current_config, desired_vlans, mode, protected_vlans):
     Calculate the difference between current and desired configuration.
     
     Returns:
-        dict with needs_change, vlans_to_create, vlans_to_delete, ports_to_configure, reasons
+        dict with needs_change, vlans_to_create, vlans_to_rename, vlans_to_delete,
+        ports_to_configure, reasons
     """
     diff = {
         'needs_change': False,
         'vlans_to_create': [],
+        'vlans_to_rename': [],
         'vlans_to_delete': [],
         'ports_to_configure': [],
         'reasons': []
@@ -360,6 +409,11 @@ def calculate_diff(current_config, desired_vlans, mode, protected_vlans):
             # VLAN exists - check if port configuration matches
             current = current_vlans[vlan_id]
             
+            if current.get('name', '') != escape_vlan_name(desired['name']):
+                diff['vlans_to_rename'].append(desired)
+                diff['needs_change'] = True
+                diff['reasons'].append(f"VLAN {vlan_id}: name differs")
+            
             current_tagged = set(current.get('tagged_ports', []))
             desired_tagged = set(desired.get('tagged_ports', []))
             current_untagged = set(current.get('untagged_ports', []))
@@ -406,18 +460,66 @@ def calculate_diff(current_config, desired_vlans, mode, protected_vlans):
     return diff
 
 
+# =============================================================================
+# STATE CACHE - Skip the get-config phase on repeated converged runs
+# =============================================================================
+
+STATE_CACHE_DIR = '~/.ansible/tp_link_vlan_cache'
+
+
+def get_state_cache_key(host, desired_vlans, mode, protected_vlans):
+    """Hash of everything that decides whether a converged switch stays converged"""
+    payload = json.dumps({
+        'host': host,
+        'vlans': desired_vlans,
+        'mode': mode,
+        'protected_vlans': sorted(protected_vlans),
+    }, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def is_state_cached(host, key, ttl):
+    """True if the switch was confirmed converged for this key less than ttl seconds ago"""
+    cache_path = os.path.join(os.path.expanduser(STATE_CACHE_DIR), f'{host}.json')
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return cached.get('key') == key and time.time() - cached.get('timestamp', 0) < ttl
+
+
+def write_state_cache(host, key):
+    """Record that the switch matches the desired state for key (atomic replace)"""
+    cache_dir = os.path.expanduser(STATE_CACHE_DIR)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='w', dir=cache_dir, delete=False) as f:
+            json.dump({'key': key, 'timestamp': time.time()}, f)
+        os.replace(f.name, os.path.join(cache_dir, f'{host}.json'))
+    except OSError:
+        pass
+
+
 # =============================================================================
 # EXPECT SCRIPT GENERATORS
 # =============================================================================
 
-def create_get_config_script(host, username, password, hostname):
-    """Generate expect script to get running-config"""
-    
-    script = f'''#!/usr/bin/expect -f
-set timeout 60
-log_user 1
+def get_ssh_mux_options(control_path, control_persist):
+    """ssh options that let all expect runs share one SSH master connection"""
+    return f"-o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist={control_persist}"
 
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{host}
+
+def create_login_block(host, username, hostname, mux_options):
+    """
+    Generate the shared SSH connect, login and enable part of an expect script.
+    
+    The password is supplied by sshpass from the SSHPASS environment variable
+    (see run_expect_script), so it never appears in the generated script.
+    mux_options (see get_ssh_mux_options) lets the scripts share one SSH connection.
+    """
+    
+    return f'''spawn sshpass -e ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {mux_options} {username}@{host}
 
 expect {{
     "No route to host" {{
@@ -436,23 +538,17 @@ expect {{
         puts "ERROR_HOST_UNREACHABLE: Host {host} is unreachable"
         exit 1
     }}
-    "password:" {{
-        send "{password}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
-        exit 1
-    }}
-}}
-
-expect {{
     "Permission denied" {{
         puts "ERROR_AUTH_FAILED: Authentication failed"
         exit 1
     }}
     "{hostname}>" {{}}
+    eof {{
+        puts "ERROR_AUTH_FAILED: Authentication failed"
+        exit 1
+    }}
     timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout"
+        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
         exit 1
     }}
 }}
@@ -469,199 +565,72 @@ expect {{
         exit 1
     }}
 }}
+'''
 
-send "terminal length 0\\r"
-expect "{hostname}#"
 
-send "show running-config\\r"
-expect "{hostname}#"
-
-send "exit\\r"
+def create_logout_block(hostname):
+    """Generate the shared logout part of an expect script (from privileged mode)"""
+    
+    return f'''send "exit\\r"
 expect "{hostname}>"
 send "exit\\r"
 expect eof
-
-puts "SUCCESS_GET_CONFIG"
 '''
-    return script
 
 
-def create_batch_vlan_script(host, username, password, vlans, hostname, diff, protected_vlans):
-    """Generate expect script for VLAN configuration based on calculated diff"""
-    
-    # Generate delete commands
-    delete_commands = ""
-    for vlan_id in diff.get('vlans_to_delete', []):
-        delete_commands += f'''send "no vlan {vlan_id}\\r"
-expect {{
-    "{hostname}(config)#" {{}}
-    "Invalid" {{
-        puts "WARNING_DELETE_FAILED: Could not delete VLAN {vlan_id}"
-    }}
-    timeout {{
-        puts "ERROR_DELETE_TIMEOUT: Timeout deleting VLAN {vlan_id}"
-        exit 1
-    }}
-}}
-'''
-    
-    # Generate create commands for new VLANs
-    create_commands = ""
-    for vlan in diff.get('vlans_to_create', []):
-        escaped_name = escape_vlan_name(vlan['name'])
-        create_commands += f'''send "vlan {vlan['id']}\\r"
-expect {{
-    "{hostname}(config-vlan)#" {{}}
-    "Invalid" {{
-        puts "ERROR_INVALID_VLAN: Invalid VLAN ID {vlan['id']}"
-        exit 1
-    }}
-    timeout {{
-        puts "ERROR_VLAN_TIMEOUT: Timeout creating VLAN {vlan['id']}"
-        exit 1
-    }}
-}}
-send "name {escaped_name}\\r"
-expect {{
-    "{hostname}(config-vlan)#" {{}}
-    "Invalid" {{
-        puts "WARNING_NAME_FAILED: Could not set name for VLAN {vlan['id']}"
-    }}
-    timeout {{
-        puts "ERROR_NAME_TIMEOUT: Timeout setting name for VLAN {vlan['id']}"
-        exit 1
-    }}
-}}
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
-    
-    # Generate port configuration commands
-    port_commands = ""
-    
-    # Configure ports for newly created VLANs
-    for vlan in diff.get('vlans_to_create', []):
-        vlan_id = vlan['id']
-        tagged_ports = vlan.get('tagged_ports', [])
-        untagged_ports = vlan.get('untagged_ports', [])
-        
-        for port in tagged_ports:
-            port_commands += f'''send "interface gigabitEthernet 1/0/{port}\\r"
-expect "{hostname}(config-if)#"
-send "switchport general allowed vlan {vlan_id} tagged\\r"
-expect "{hostname}(config-if)#"
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
-        
-        for port in untagged_ports:
-            port_commands += f'''send "interface gigabitEthernet 1/0/{port}\\r"
-expect "{hostname}(config-if)#"
-send "switchport general allowed vlan {vlan_id} untagged\\r"
-expect "{hostname}(config-if)#"
-send "switchport pvid {vlan_id}\\r"
-expect "{hostname}(config-if)#"
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
+def create_get_config_script(host, username, hostname, mux_options):
+    """Generate expect script to get running-config"""
     
-    # Configure ports that need changes on existing VLANs
-    for port_config in diff.get('ports_to_configure', []):
-        vlan_id = port_config['vlan_id']
-        
-        for port in port_config.get('add_tagged', []):
-            port_commands += f'''send "interface gigabitEthernet 1/0/{port}\\r"
-expect "{hostname}(config-if)#"
-send "switchport general allowed vlan {vlan_id} tagged\\r"
-expect "{hostname}(config-if)#"
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
-        
-        for port in port_config.get('add_untagged', []):
-            port_commands += f'''send "interface gigabitEthernet 1/0/{port}\\r"
-expect "{hostname}(config-if)#"
-send "switchport general allowed vlan {vlan_id} untagged\\r"
-expect "{hostname}(config-if)#"
-send "switchport pvid {vlan_id}\\r"
-expect "{hostname}(config-if)#"
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
-        
-        for port in port_config.get('remove_tagged', []):
-            port_commands += f'''send "interface gigabitEthernet 1/0/{port}\\r"
-expect "{hostname}(config-if)#"
-send "no switchport general allowed vlan {vlan_id}\\r"
-expect "{hostname}(config-if)#"
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
-        
-        for port in port_config.get('remove_untagged', []):
-            port_commands += f'''send "interface gigabitEthernet 1/0/{port}\\r"
-expect "{hostname}(config-if)#"
-send "no switchport general allowed vlan {vlan_id}\\r"
-expect "{hostname}(config-if)#"
-send "switchport pvid 1\\r"
-expect "{hostname}(config-if)#"
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
+    login_block = create_login_block(host, username, hostname, mux_options)
+    logout_block = create_logout_block(hostname)
     
-    script = f'''#!/usr/bin/expect -f
-set timeout 30
-log_user 1
+    script = f'''set timeout 60
+log_user 0
 
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{host}
+{login_block}
+send "terminal length 0\\r"
+expect "{hostname}#"
 
+# Only forward the lines parse_running_config() needs
+send "show running-config\\r"
 expect {{
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to host {host}"
-        exit 1
-    }}
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Connection refused by {host}"
-        exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {host} timed out"
-        exit 1
-    }}
-    "password:" {{
-        send "{password}\\r"
+    -re {{([^\\r\\n]*)\\r?\\n}} {{
+        set line $expect_out(1,string)
+        if {{[regexp {{^\\s*(vlan|name|interface|switchport|#|end)}} $line]}} {{
+            puts $line
+        }}
+        exp_continue
     }}
+    "{hostname}#" {{}}
     timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
+        puts "ERROR_SHOW_TIMEOUT: Timeout reading running-config"
         exit 1
     }}
 }}
 
-expect {{
-    "Permission denied" {{
-        puts "ERROR_AUTH_FAILED: Authentication failed"
-        exit 1
-    }}
-    "{hostname}>" {{}}
-    timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout"
-        exit 1
-    }}
-}}
+{logout_block}
+puts "SUCCESS_GET_CONFIG"
+'''
+    return script
 
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
-        puts "ERROR_ENABLE_PASSWORD: Enable password required"
-        exit 1
-    }}
-    timeout {{
-        puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
-        exit 1
-    }}
-}}
 
+@functools.lru_cache(maxsize=8)
+def build_batch_vlan_template(hostname):
+    """
+    Pre-render the fixed frame of the batch VLAN script for one CLI hostname.
+    
+    Login, configure, save and logout only depend on the hostname, so they are
+    rendered once and cached; $host, $username, $mux_options and the per-run
+    command blocks are filled in by create_batch_vlan_script().
+    """
+    
+    login_block = create_login_block('$host', '$username', hostname, '$mux_options')
+    logout_block = create_logout_block(hostname)
+    
+    return string.Template(f'''set timeout 30
+log_user 0
+
+{login_block}
 send "configure\\r"
 expect {{
     "{hostname}(config)#" {{}}
@@ -672,13 +641,13 @@ expect {{
 }}
 
 # === DELETE PHASE ===
-{delete_commands}
+$delete_commands
 
 # === CREATE PHASE ===
-{create_commands}
+$create_commands
 
 # === PORT CONFIGURATION PHASE ===
-{port_commands}
+$port_commands
 
 # === SAVE CONFIG ===
 send "exit\\r"
@@ -698,72 +667,222 @@ expect {{
     }}
 }}
 
-send "exit\\r"
-expect "{hostname}>"
-send "exit\\r"
-expect eof
-
+{logout_block}
 puts "SUCCESS_COMPLETE"
+''')
+
+
+# Switchport commands per port change, keyed like the ports_to_configure entries
+PORT_VLAN_COMMANDS = {
+    'add_tagged': ('switchport general allowed vlan {vlan_id} tagged',),
+    'add_untagged': ('switchport general allowed vlan {vlan_id} untagged', 'switchport pvid {vlan_id}'),
+    'remove_tagged': ('no switchport general allowed vlan {vlan_id}',),
+    'remove_untagged': ('no switchport general allowed vlan {vlan_id}', 'switchport pvid 1'),
+}
+
+
+def create_port_block(hostname, port, action, vlan_id):
+    """Generate the interface block applying one PORT_VLAN_COMMANDS action to a port"""
+    
+    lines = [
+        f'send "interface gigabitEthernet 1/0/{port}\\r"',
+        f'expect "{hostname}(config-if)#"',
+    ]
+    for command in PORT_VLAN_COMMANDS[action]:
+        lines.append(f'send "{command.format(vlan_id=vlan_id)}\\r"')
+        lines.append(f'expect "{hostname}(config-if)#"')
+    lines.append('send "exit\\r"')
+    lines.append(f'expect "{hostname}(config)#"')
+    return "\n".join(lines) + "\n"
+
+
+def create_batch_vlan_script(host, username, hostname, diff, mux_options):
+    """Generate expect script for VLAN configuration based on calculated diff"""
+    
+    # Generate delete command - one "no vlan 2-5,7" instead of one command per VLAN
+    delete_commands = ""
+    if diff.get('vlans_to_delete'):
+        vlan_list = format_vlan_ranges(diff['vlans_to_delete'])
+        delete_commands = f'''send "no vlan {vlan_list}\\r"
+expect {{
+    "{hostname}(config)#" {{}}
+    "Invalid" {{
+        puts "WARNING_DELETE_FAILED: Could not delete VLAN {vlan_list}"
+    }}
+    timeout {{
+        puts "ERROR_DELETE_TIMEOUT: Timeout deleting VLAN {vlan_list}"
+        exit 1
+    }}
+}}
 '''
-    return script
+    
+    # Generate create commands for new VLANs (re-entering an existing VLAN renames it)
+    create_commands = []
+    for vlan in diff.get('vlans_to_create', []) + diff.get('vlans_to_rename', []):
+        escaped_name = escape_vlan_name(vlan['name'])
+        # Both lines go out in one send; the two prompts are then matched in order
+        create_commands.append(f'''send "vlan {vlan['id']}\\rname {escaped_name}\\r"
+expect {{
+    "{hostname}(config-vlan)#" {{}}
+    "Invalid" {{
+        puts "ERROR_INVALID_VLAN: Invalid VLAN ID {vlan['id']}"
+        exit 1
+    }}
+    timeout {{
+        puts "ERROR_VLAN_TIMEOUT: Timeout creating VLAN {vlan['id']}"
+        exit 1
+    }}
+}}
+expect {{
+    "{hostname}(config-vlan)#" {{}}
+    "Invalid" {{
+        puts "WARNING_NAME_FAILED: Could not set name for VLAN {vlan['id']}"
+    }}
+    timeout {{
+        puts "ERROR_NAME_TIMEOUT: Timeout setting name for VLAN {vlan['id']}"
+        exit 1
+    }}
+}}
+''')
+    
+    # "vlan M" is accepted directly at the (config-vlan)# prompt, so leave
+    # VLAN mode only once after the last VLAN
+    if create_commands:
+        create_commands.append(f'''send "exit\\r"
+expect "{hostname}(config)#"
+''')
+    
+    # Generate port configuration commands
+    port_commands = []
+    
+    # Configure ports for newly created VLANs
+    for vlan in diff.get('vlans_to_create', []):
+        for port in vlan.get('tagged_ports', []):
+            port_commands.append(create_port_block(hostname, port, 'add_tagged', vlan['id']))
+        for port in vlan.get('untagged_ports', []):
+            port_commands.append(create_port_block(hostname, port, 'add_untagged', vlan['id']))
+    
+    # Configure ports that need changes on existing VLANs
+    for port_config in diff.get('ports_to_configure', []):
+        for action in PORT_VLAN_COMMANDS:
+            for port in port_config.get(action, []):
+                port_commands.append(create_port_block(hostname, port, action, port_config['vlan_id']))
+    
+    return build_batch_vlan_template(hostname).substitute(
+        host=host,
+        username=username,
+        mux_options=mux_options,
+        delete_commands=delete_commands,
+        create_commands="".join(create_commands),
+        port_commands="".join(port_commands),
+    )
 
 
 # =============================================================================
 # OUTPUT ANALYSIS
 # =============================================================================
 
+# Error markers printed by the expect scripts, mapped to user-facing messages
+ERROR_MESSAGES = {
+    "ERROR_CONNECTION_FAILED": "Connection failed: No route to host",
+    "ERROR_CONNECTION_REFUSED": "Connection refused: SSH port not open",
+    "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
+    "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
+    "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
+    "ERROR_ENABLE_PASSWORD": "Enable password required",
+    "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
+    "ERROR_CONFIG_TIMEOUT": "Timeout entering config mode",
+    "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
+    "ERROR_DELETE_TIMEOUT": "Timeout deleting VLAN",
+    "ERROR_VLAN_TIMEOUT": "Timeout creating VLAN",
+    "ERROR_NAME_TIMEOUT": "Timeout setting VLAN name",
+    "ERROR_INVALID_VLAN": "Invalid VLAN ID",
+    "ERROR_SHOW_TIMEOUT": "Timeout reading running-config",
+}
+
+# One scan of the output finds the first marker instead of one substring search per marker
+ERROR_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in ERROR_MESSAGES))
+SUCCESS_MARKER_RE = re.compile(r'SUCCESS_(?:COMPLETE|CONFIG_SAVED|GET_CONFIG)|Saving user config OK!')
+
+
 def analyze_output(stdout, stderr):
     """Analyze expect output for errors"""
     
-    error_patterns = {
-        "ERROR_CONNECTION_FAILED": "Connection failed: No route to host",
-        "ERROR_CONNECTION_REFUSED": "Connection refused: SSH port not open",
-        "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
-        "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
-        "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
-        "ERROR_ENABLE_PASSWORD": "Enable password required",
-        "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
-        "ERROR_CONFIG_TIMEOUT": "Timeout entering config mode",
-        "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
-        "ERROR_DELETE_TIMEOUT": "Timeout deleting VLAN",
-        "ERROR_VLAN_TIMEOUT": "Timeout creating VLAN",
-        "ERROR_NAME_TIMEOUT": "Timeout setting VLAN name",
-        "ERROR_INVALID_VLAN": "Invalid VLAN ID",
-    }
-    
     combined = stdout + stderr
     
-    for error_key, error_msg in error_patterns.items():
-        if error_key in combined:
-            return False, error_msg
+    error_match = ERROR_MARKER_RE.search(combined)
+    if error_match:
+        return False, ERROR_MESSAGES[error_match.group(0)]
     
-    if "SUCCESS_COMPLETE" in combined or "SUCCESS_CONFIG_SAVED" in combined or "SUCCESS_GET_CONFIG" in combined:
-        return True, None
-    
-    if "Saving user config OK!" in combined:
+    if SUCCESS_MARKER_RE.search(combined):
         return True, None
     
     return False, "Unknown error - check stdout"
 
 
-def run_expect_script(script_content, timeout=180):
-    """Run an expect script and return the result"""
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.exp', delete=False) as f:
-        f.write(script_content)
-        script_path = f.name
+def feed_script(pipe, script_content):
+    """Write the script to expect's stdin; expect may exit before reading all of it"""
+    try:
+        pipe.write(script_content)
+        pipe.close()
+    except OSError:
+        pass
+
+
+def run_expect_script(script_content, password, timeout=180):
+    """
+    Run an expect script and return the result (password is passed to sshpass via SSHPASS).
+    
+    The script is piped to 'expect -f -' instead of being written to a temp file.
+    Output is read line by line while the script runs; the first ERROR_ marker
+    stops the script instead of waiting for it to wind down. stderr is merged
+    into stdout, so the returned stderr is always empty.
+    """
+    proc = subprocess.Popen(
+        ['expect', '-f', '-'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        # VLAN names come back verbatim; a stray non-UTF-8 byte must not abort the read
+        errors='replace',
+        env=dict(os.environ, SSHPASS=password)
+    )
+    # Fed from a thread so a large script can never deadlock against a full stdout pipe
+    threading.Thread(target=feed_script, args=(proc.stdin, script_content), daemon=True).start()
     
+    # Reading blocks, so the overall timeout is enforced by killing the process
+    deadline = time.monotonic() + timeout
+    killer = threading.Timer(timeout, proc.kill)
+    killer.start()
+    lines = []
     try:
-        os.chmod(script_path, 0o700)
-        result = subprocess.run(
-            [script_path],
+        for line in proc.stdout:
+            lines.append(line)
+            if line.startswith('ERROR_'):
+                proc.terminate()
+                break
+        proc.wait()
+    finally:
+        killer.cancel()
+        proc.stdout.close()
+    
+    if time.monotonic() >= deadline:
+        raise subprocess.TimeoutExpired('expect', timeout)
+    return "".join(lines), "", proc.returncode
+
+
+def close_ssh_master(host, username, control_path, control_dir):
+    """Stop the shared SSH master connection and remove its socket directory"""
+    try:
+        subprocess.run(
+            ['ssh', '-o', f'ControlPath={control_path}', '-O', 'exit', f'{username}@{host}'],
             capture_output=True,
-            text=True,
-            timeout=timeout
+            timeout=10
         )
-        return result.stdout, result.stderr, result.returncode
-    finally:
-        if os.path.exists(script_path):
-            os.unlink(script_path)
+    except (OSError, subprocess.SubprocessError):
+        pass
+    shutil.rmtree(control_dir, ignore_errors=True)
 
 
 # =============================================================================
@@ -780,6 +899,8 @@ def main():
             hostname=dict(type='str', required=False, default='SG3210'),
             mode=dict(type='str', required=False, default='add', choices=['add', 'replace']),
             protected_vlans=dict(type='list', required=False, default=[1], elements='int'),
+            control_persist=dict(type='int', required=False, default=0),
+            cache_ttl=dict(type='int', required=False, default=0),
         ),
         supports_check_mode=True
     )
@@ -790,22 +911,54 @@ def main():
     vlans_raw = module.params['vlans']
     hostname = module.params['hostname']
     mode = module.params['mode']
-    protected_vlans = module.params['protected_vlans']
+    # frozenset: checked once per VLAN in calculate_diff()
+    protected_vlans = frozenset(module.params['protected_vlans'])
+    control_persist = module.params['control_persist']
+    cache_ttl = module.params['cache_ttl']
     
     # SG3210 has 10 ports
     max_port = 10
     
+    # Password is handed to ssh by sshpass, not written into the script
+    module.get_bin_path('expect', required=True)
+    module.get_bin_path('sshpass', required=True)
+    
     # Validate VLAN list
     validate_vlans(module, vlans_raw, protected_vlans, max_port)
     
     # Normalize VLANs
     desired_vlans = normalize_vlans(vlans_raw)
     
+    # Skip both SSH phases if this exact state was confirmed within cache_ttl
+    cache_key = get_state_cache_key(host, desired_vlans, mode, protected_vlans)
+    if cache_ttl > 0 and is_state_cached(host, cache_key, cache_ttl):
+        module.exit_json(
+            changed=False,
+            msg="Configuration already matches desired state (cached)",
+            host=host,
+            mode=mode,
+            desired_vlans=[v['id'] for v in desired_vlans],
+        )
+    
+    # Get-config and configure phase share one SSH connection (OpenSSH multiplexing).
+    # With control_persist the master outlives this task and is reused by later
+    # tasks against the same switch/user.
+    if control_persist > 0:
+        control_dir = os.path.expanduser('~/.ansible/cp')
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+        control_path = os.path.join(control_dir, 'tp_link-%r@%h:%p')
+        mux_options = get_ssh_mux_options(control_path, control_persist)
+    else:
+        control_dir = tempfile.mkdtemp(prefix='tp_link_ssh_')
+        control_path = os.path.join(control_dir, '%r@%h:%p')
+        mux_options = get_ssh_mux_options(control_path, 30)
+        atexit.register(close_ssh_master, host, username, control_path, control_dir)
+    
     # === STEP 1: Get current configuration ===
-    get_config_script = create_get_config_script(host, username, password, hostname)
+    get_config_script = create_get_config_script(host, username, hostname, mux_options)
     
     try:
-        stdout, stderr, returncode = run_expect_script(get_config_script, timeout=60)
+        stdout, stderr, returncode = run_expect_script(get_config_script, password, timeout=60)
     except subprocess.TimeoutExpired:
         module.fail_json(msg="Timeout getting current configuration", host=host)
     except Exception as e:
@@ -828,6 +981,8 @@ def main():
     
     # === STEP 4: Check if changes are needed ===
     if not diff['needs_change']:
+        if cache_ttl > 0:
+            write_state_cache(host, cache_key)
         module.exit_json(
             changed=False,
             msg="Configuration already matches desired state",
@@ -849,11 +1004,11 @@ def main():
     
     # === STEP 6: Apply changes ===
     config_script = create_batch_vlan_script(
-        host, username, password, desired_vlans, hostname, diff, protected_vlans
+        host, username, hostname, diff, mux_options
     )
     
     try:
-        stdout, stderr, returncode = run_expect_script(config_script, timeout=180)
+        stdout, stderr, returncode = run_expect_script(config_script, password, timeout=180)
     except subprocess.TimeoutExpired:
         module.fail_json(
             msg="Total timeout exceeded (180s) - switch not responding",
@@ -874,7 +1029,11 @@ def main():
         )
     
     # === STEP 7: Report success ===
+    if cache_ttl > 0:
+        write_state_cache(host, cache_key)
+    
     vlans_created = len(diff.get('vlans_to_create', []))
+    vlans_renamed = len(diff.get('vlans_to_rename', []))
     vlans_deleted = len(diff.get('vlans_to_delete', []))
     ports_changed = len(diff.get('ports_to_configure', []))
     
@@ -884,6 +1043,7 @@ def main():
         host=host,
         mode=mode,
         vlans_created=vlans_created,
+        vlans_renamed=vlans_renamed,
         vlans_deleted=vlans_deleted,
         ports_changed=ports_changed,
         changes=diff['reasons'],
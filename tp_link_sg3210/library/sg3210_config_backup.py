@@ -21,6 +21,7 @@ Parameters:
     backup_dir: Directory for local backups (default: ./backups)
     backup_file: Filename for backup (default: {hostname}_{date}.cfg)
     config_file: Path to config file for restore_local
+    control_persist: Seconds to keep the SSH connection open for later tasks (default: 0)
 
 Examples:
     # Backup on switch
@@ -48,11 +49,32 @@ Examples:
 
 from ansible.module_utils.basic import AnsibleModule
 import subprocess
-import tempfile
 import os
 import re
+import socket
+import string
+import uuid
 from datetime import datetime
 
+# Seconds to wait for the SSH port before giving up without starting expect
+SSH_PROBE_TIMEOUT = 5
+
+# Commands sent per burst by restore_local; small enough for the switch's input buffer
+RESTORE_SEND_BATCH = 8
+
+# restore_local: lines never replayed - user accounts, password hashes and "end"
+# (the script leaves config mode itself)
+SKIP_COMMAND_RE = re.compile(r'^user name|\bsecret |^end$', re.IGNORECASE)
+
+# restore_local: which CLI mode a config line belongs to; unmatched lines are global
+COMMAND_KIND_RE = re.compile(
+    r'^(?:(?P<port_channel>interface port-channel)'
+    r'|(?P<vlan>vlan )'
+    r'|(?P<name>name )'
+    r'|(?P<interface>interface )'
+    r'|(?P<interface_sub>switchport |mac address-table max-mac-count|channel-group))'
+)
+
 
 DOCUMENTATION = r'''
 module: tp_link_config_backup
@@ -90,6 +112,14 @@ options:
     config_file:
         description: Path to config file for restore_local action
         required: false
+    control_persist:
+        description:
+            - Seconds to keep the SSH master connection open after the task, so later
+              tasks against the same switch and user reuse it instead of logging in again
+            - 0 only reuses a master left open by an earlier task (e.g. the batch VLAN modules)
+        required: false
+        default: 0
+        type: int
 '''
 
 EXAMPLES = r'''
@@ -125,352 +155,242 @@ EXAMPLES = r'''
 '''
 
 
-def create_backup_switch_script(host, username, password, hostname):
-    """Backup running-config to backup-config on switch"""
-    
-    script = f'''#!/usr/bin/expect -f
-set timeout 30
+# Shared by every action: connect, log in and enter enable mode (ends at the "#" prompt).
+# The password is not part of the script: expect reads it from its environment
+# (script_env()), so it needs no Tcl quoting and never appears in the script text.
+LOGIN_SCRIPT_TEMPLATE = string.Template(r'''set timeout ${timeout}
 log_user 1
 
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{host}
+set logged_in 0
+spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 -o ServerAliveInterval=5 -o ServerAliveCountMax=3 ${mux_options} ${username}@${host}
 
-expect {{
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to host {host}"
+expect {
+    "No route to host" {
+        puts "ERROR_CONNECTION_FAILED: No route to host ${host}"
         exit 1
-    }}
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Connection refused by {host}"
-        exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {host} timed out"
-        exit 1
-    }}
-    "Host is unreachable" {{
-        puts "ERROR_HOST_UNREACHABLE: Host {host} is unreachable"
-        exit 1
-    }}
-    "password:" {{
-        send "{password}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
+    }
+    "Connection refused" {
+        puts "ERROR_CONNECTION_REFUSED: Connection refused by ${host}"
         exit 1
-    }}
-}}
-
-expect {{
-    "Permission denied" {{
-        puts "ERROR_AUTH_FAILED: Authentication failed - wrong username or password"
+    }
+    "Connection timed out" {
+        puts "ERROR_CONNECTION_TIMEOUT: Connection to ${host} timed out"
         exit 1
-    }}
-    "Access denied" {{
-        puts "ERROR_AUTH_FAILED: Access denied - wrong username or password"
+    }
+    "Host is unreachable" {
+        puts "ERROR_HOST_UNREACHABLE: Host ${host} is unreachable"
         exit 1
-    }}
-    "{hostname}>" {{}}
-    timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout - check username/password"
+    }
+    "password:" {
+        send "$$env(TP_PASSWORD)\r"
+    }
+    "${hostname}>" {
+        # Multiplexed session - no password prompt
+        set logged_in 1
+    }
+    timeout {
+        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to ${host}"
         exit 1
-    }}
-}}
+    }
+}
+
+if {!$$logged_in} {
+    expect {
+        "Permission denied" {
+            puts "ERROR_AUTH_FAILED: Authentication failed - wrong username or password"
+            exit 1
+        }
+        "Access denied" {
+            puts "ERROR_AUTH_FAILED: Access denied - wrong username or password"
+            exit 1
+        }
+        "${hostname}>" {}
+        timeout {
+            puts "ERROR_AUTH_FAILED: Login timeout - check username/password"
+            exit 1
+        }
+    }
+}
 
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
+send "enable\r"
+expect {
+    "${hostname}#" {}
+    "Password:" {
         puts "ERROR_ENABLE_PASSWORD: Enable password required but not provided"
         exit 1
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
         exit 1
-    }}
-}}
+    }
+}
 
-send "copy running-config backup-config\\r"
-expect {{
-    "Saving user config OK!" {{
-        puts "SUCCESS_BACKUP_COMPLETE"
-    }}
-    "Succeed" {{
-        puts "SUCCESS_BACKUP_COMPLETE"
-    }}
-    timeout {{
-        puts "ERROR_BACKUP_TIMEOUT: Timeout during backup"
-        exit 1
-    }}
-}}
+''')
 
-expect "{hostname}#"
-send "exit\\r"
-expect "{hostname}>"
-send "exit\\r"
+# Shared by every action: leave enable mode and close the session (starts at the "#" prompt)
+LOGOUT_SCRIPT_TEMPLATE = string.Template(r'''
+send "exit\r"
+expect "${hostname}>"
+send "exit\r"
 expect eof
-'''
-    return script
+''')
 
 
-def create_show_config_script(host, username, password, hostname):
-    """Get running-config for local backup"""
+def build_script(body, timeout, host, username, hostname, mux_options):
+    """Wrap an action's commands in the shared login and logout sequence"""
     
-    script = f'''#!/usr/bin/expect -f
-set timeout 60
-log_user 1
+    return (
+        LOGIN_SCRIPT_TEMPLATE.substitute(
+            timeout=timeout, host=host, username=username, hostname=hostname, mux_options=mux_options
+        )
+        + body
+        + LOGOUT_SCRIPT_TEMPLATE.substitute(hostname=hostname)
+    )
 
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{host}
 
-expect {{
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to host {host}"
-        exit 1
-    }}
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Connection refused by {host}"
-        exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {host} timed out"
-        exit 1
-    }}
-    "Host is unreachable" {{
-        puts "ERROR_HOST_UNREACHABLE: Host {host} is unreachable"
-        exit 1
-    }}
-    "password:" {{
-        send "{password}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
+# Fixed action bodies are parsed once at import; the create_*_script() functions only substitute values
+BACKUP_SWITCH_BODY_TEMPLATE = string.Template(r'''send "copy running-config backup-config\r"
+expect {
+    "Saving user config OK!" {
+        puts "SUCCESS_BACKUP_COMPLETE"
+    }
+    "Succeed" {
+        puts "SUCCESS_BACKUP_COMPLETE"
+    }
+    timeout {
+        puts "ERROR_BACKUP_TIMEOUT: Timeout during backup"
         exit 1
-    }}
-}}
+    }
+}
 
-expect {{
-    "Permission denied" {{
-        puts "ERROR_AUTH_FAILED: Authentication failed - wrong username or password"
-        exit 1
-    }}
-    "Access denied" {{
-        puts "ERROR_AUTH_FAILED: Access denied - wrong username or password"
-        exit 1
-    }}
-    "{hostname}>" {{}}
-    timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout - check username/password"
-        exit 1
-    }}
-}}
+expect "${hostname}#"
+''')
 
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
-        puts "ERROR_ENABLE_PASSWORD: Enable password required but not provided"
-        exit 1
-    }}
-    timeout {{
-        puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
-        exit 1
-    }}
-}}
 
-send "terminal length 0\\r"
-expect "{hostname}#"
+def create_backup_switch_script(host, username, hostname, mux_options):
+    """Backup running-config to backup-config on switch"""
+    
+    body = BACKUP_SWITCH_BODY_TEMPLATE.substitute(hostname=hostname)
+    return build_script(body, 30, host, username, hostname, mux_options)
 
-puts "CONFIG_START_MARKER"
-send "show running-config\\r"
-expect "{hostname}#"
-puts "CONFIG_END_MARKER"
 
-send "exit\\r"
-expect "{hostname}>"
-send "exit\\r"
-expect eof
+SHOW_CONFIG_BODY_TEMPLATE = string.Template(r'''# Logged in: from here on only the config dump itself is mirrored to stdout
+log_user 0
+send "terminal length 0\r"
+expect "${hostname}#"
 
+puts "CONFIG_START_${marker}"
+log_user 1
+send "show running-config\r"
+expect "${hostname}#"
+log_user 0
+puts "CONFIG_END_${marker}"
 puts "SUCCESS_CONFIG_RETRIEVED"
-'''
-    return script
+''')
 
 
-def create_restore_switch_script(host, username, password, hostname):
-    """Restore backup-config to running-config and save"""
+def create_show_config_script(host, username, hostname, mux_options, marker):
+    """Get running-config for local backup, framed by CONFIG_START_/CONFIG_END_<marker> lines"""
     
-    script = f'''#!/usr/bin/expect -f
-set timeout 30
-log_user 1
+    body = SHOW_CONFIG_BODY_TEMPLATE.substitute(hostname=hostname, marker=marker)
+    return build_script(body, 60, host, username, hostname, mux_options)
 
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{host}
-
-expect {{
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to host {host}"
-        exit 1
-    }}
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Connection refused by {host}"
-        exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {host} timed out"
-        exit 1
-    }}
-    "Host is unreachable" {{
-        puts "ERROR_HOST_UNREACHABLE: Host {host} is unreachable"
-        exit 1
-    }}
-    "password:" {{
-        send "{password}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
-        exit 1
-    }}
-}}
 
-expect {{
-    "Permission denied" {{
-        puts "ERROR_AUTH_FAILED: Authentication failed - wrong username or password"
-        exit 1
-    }}
-    "Access denied" {{
-        puts "ERROR_AUTH_FAILED: Access denied - wrong username or password"
-        exit 1
-    }}
-    "{hostname}>" {{}}
-    timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout - check username/password"
-        exit 1
-    }}
-}}
-
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
-        puts "ERROR_ENABLE_PASSWORD: Enable password required but not provided"
-        exit 1
-    }}
-    timeout {{
-        puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
-        exit 1
-    }}
-}}
-
-send "copy backup-config startup-config\\r"
-expect {{
-    "Saving user config OK!" {{
+RESTORE_SWITCH_BODY_TEMPLATE = string.Template(r'''send "copy backup-config startup-config\r"
+expect {
+    "Saving user config OK!" {
         puts "SUCCESS_RESTORE_COMPLETE"
-    }}
-    "Succeed" {{
+    }
+    "Succeed" {
         puts "SUCCESS_RESTORE_COMPLETE"
-    }}
-    "No backup configuration" {{
+    }
+    "No backup configuration" {
         puts "ERROR_NO_BACKUP: No backup configuration exists on switch"
         exit 1
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_RESTORE_TIMEOUT: Timeout during restore"
         exit 1
-    }}
-}}
+    }
+}
+
+expect "${hostname}#"
+''')
 
-expect "{hostname}#"
-send "exit\\r"
-expect "{hostname}>"
-send "exit\\r"
-expect eof
-'''
-    return script
 
+def create_restore_switch_script(host, username, hostname, mux_options):
+    """Restore backup-config to running-config and save"""
+    
+    body = RESTORE_SWITCH_BODY_TEMPLATE.substitute(hostname=hostname)
+    return build_script(body, 30, host, username, hostname, mux_options)
 
-def create_restore_local_script(host, username, password, hostname, config_commands):
+
+def create_restore_local_script(host, username, hostname, config_commands, mux_options):
     """Apply configuration commands from local file with intelligent mode handling"""
     
-    # Build command sequence with mode awareness
-    command_section = ""
+    # Build command sequence with mode awareness as (command, expect block) steps
+    steps = []
     current_mode = "config"  # Start in (config)# mode
+    leave_mode = ("exit", f'''expect "{hostname}(config)#"
+''')
     
     for cmd in config_commands:
         cmd = cmd.strip()
         if not cmd or cmd.startswith('!') or cmd.startswith('#'):
             continue
         
-        # Skip problematic commands 
-        skip_patterns = [
-            'user name',      # Don't overwrite user credentials
-            'secret ',        # Password hashes
-            'end',            # We handle this ourselves
-        ]
-        if any(pattern in cmd.lower() for pattern in skip_patterns):
+        if SKIP_COMMAND_RE.search(cmd):
             continue
         
         # Escape special characters for expect
         cmd_escaped = cmd.replace('"', '\\"').replace("'", "\\'")
         
-        # Determine what mode this command needs
-        if cmd.startswith('interface port-channel'):
+        # Determine what mode this command needs (one regex match per line)
+        kind_match = COMMAND_KIND_RE.match(cmd)
+        kind = kind_match.lastgroup if kind_match else 'global'
+        
+        if kind == 'port_channel':
             # Port-channel interface - enter interface mode
-            if current_mode == "config-vlan":
-                command_section += f'''send "exit\\r"
-expect "{hostname}(config)#"
-'''
-            elif current_mode == "config-if":
-                command_section += f'''send "exit\\r"
-expect "{hostname}(config)#"
-'''
-            command_section += f'''send "{cmd_escaped}\\r"
-expect {{
+            if current_mode in ("config-vlan", "config-if"):
+                steps.append(leave_mode)
+            steps.append((cmd_escaped, f'''expect {{
     "{hostname}(config-if)#" {{}}
     "{hostname}(config)#" {{}}
     timeout {{
         puts "WARNING: Timeout entering port-channel interface"
     }}
 }}
-'''
+'''))
             current_mode = "config-if"
             
-        elif cmd.startswith('vlan ') and not cmd.startswith('vlan-'):
+        elif kind == 'vlan':
             # VLAN command - need to be in config mode, will enter config-vlan
             if current_mode != "config":
-                command_section += f'''send "exit\\r"
-expect "{hostname}(config)#"
-'''
-            command_section += f'''send "{cmd_escaped}\\r"
-expect "{hostname}(config-vlan)#"
-'''
+                steps.append(leave_mode)
+            steps.append((cmd_escaped, f'''expect "{hostname}(config-vlan)#"
+'''))
             current_mode = "config-vlan"
             
-        elif cmd.startswith('name '):
+        elif kind == 'name':
             # VLAN name - must be in config-vlan mode
-            command_section += f'''send "{cmd_escaped}\\r"
-expect "{hostname}(config-vlan)#"
-'''
+            steps.append((cmd_escaped, f'''expect "{hostname}(config-vlan)#"
+'''))
             
-        elif cmd.startswith('interface '):
+        elif kind == 'interface':
             # Interface command - need to exit to config first, then enter interface
-            if current_mode == "config-vlan":
-                command_section += f'''send "exit\\r"
-expect "{hostname}(config)#"
-'''
-            elif current_mode == "config-if":
-                command_section += f'''send "exit\\r"
-expect "{hostname}(config)#"
-'''
-            command_section += f'''send "{cmd_escaped}\\r"
-expect {{
+            if current_mode in ("config-vlan", "config-if"):
+                steps.append(leave_mode)
+            steps.append((cmd_escaped, f'''expect {{
     "{hostname}(config-if)#" {{}}
     "{hostname}(config)#" {{}}
 }}
-'''
+'''))
             current_mode = "config-if"
             
-        elif cmd.startswith('switchport ') or cmd.startswith('mac address-table max-mac-count') or cmd.startswith('channel-group'):
+        elif kind == 'interface_sub':
             # Interface sub-command - must be in config-if mode
             if current_mode == "config-if":
-                command_section += f'''send "{cmd_escaped}\\r"
-expect {{
+                steps.append((cmd_escaped, f'''expect {{
     "{hostname}(config-if)#" {{}}
     "already a member" {{
         puts "WARNING: Port already in LAG"
@@ -482,92 +402,33 @@ expect {{
         puts "WARNING: Timeout after: {cmd_escaped}"
     }}
 }}
-'''
+'''))
             # Skip if not in interface mode
             
         else:
             # Global config command - must be in (config)# mode
-            if current_mode == "config-vlan":
-                command_section += f'''send "exit\\r"
-expect "{hostname}(config)#"
-'''
-                current_mode = "config"
-            elif current_mode == "config-if":
-                command_section += f'''send "exit\\r"
-expect "{hostname}(config)#"
-'''
+            if current_mode in ("config-vlan", "config-if"):
+                steps.append(leave_mode)
                 current_mode = "config"
             
-            command_section += f'''send "{cmd_escaped}\\r"
-expect {{
+            steps.append((cmd_escaped, f'''expect {{
     "{hostname}(config)#" {{}}
     "{hostname}#" {{}}
     timeout {{ puts "WARNING: Timeout after: {cmd_escaped}" }}
 }}
-'''
+'''))
     
-    script = f'''#!/usr/bin/expect -f
-set timeout 15
-log_user 1
-
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{host}
-
-expect {{
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to host {host}"
-        exit 1
-    }}
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Connection refused by {host}"
-        exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {host} timed out"
-        exit 1
-    }}
-    "Host is unreachable" {{
-        puts "ERROR_HOST_UNREACHABLE: Host {host} is unreachable"
-        exit 1
-    }}
-    "password:" {{
-        send "{password}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
-        exit 1
-    }}
-}}
-
-expect {{
-    "Permission denied" {{
-        puts "ERROR_AUTH_FAILED: Authentication failed - wrong username or password"
-        exit 1
-    }}
-    "Access denied" {{
-        puts "ERROR_AUTH_FAILED: Access denied - wrong username or password"
-        exit 1
-    }}
-    "{hostname}>" {{}}
-    timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout - check username/password"
-        exit 1
-    }}
-}}
-
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
-        puts "ERROR_ENABLE_PASSWORD: Enable password required but not provided"
-        exit 1
-    }}
-    timeout {{
-        puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
-        exit 1
-    }}
-}}
-
-send "configure\\r"
+    # Pipeline the commands: one send per batch, then the batch's expect blocks
+    # consume the prompts in the same order the commands were sent
+    command_section = []
+    for i in range(0, len(steps), RESTORE_SEND_BATCH):
+        batch = steps[i:i + RESTORE_SEND_BATCH]
+        commands = "".join(f"{cmd}\\r" for cmd, _ in batch)
+        command_section.append(f'send "{commands}"\n')
+        command_section.extend(expect_block for _, expect_block in batch)
+    command_section = "".join(command_section)
+    
+    body = f'''send "configure\\r"
 expect "{hostname}(config)#"
 
 # === APPLY CONFIG COMMANDS ===
@@ -592,132 +453,128 @@ expect {{
 }}
 
 expect "{hostname}#"
-send "exit\\r"
-expect "{hostname}>"
-send "exit\\r"
-expect {{
-    eof {{}}
-    "Connection closed" {{}}
-    timeout {{}}
-}}
-
 puts "SUCCESS_COMPLETE"
 '''
-    return script
+    return build_script(body, 15, host, username, hostname, mux_options)
+
+
+def probe_port(ip, port, timeout=SSH_PROBE_TIMEOUT):
+    """Return None if a TCP connect to the port succeeds, else the connect error"""
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return None
+    except OSError as e:
+        return e
+
 
+def get_ssh_mux_options(control_path, control_persist):
+    """ssh options for connection sharing; with control_persist 0 an existing master is only reused"""
+    if control_persist > 0:
+        return f"-o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist={control_persist}"
+    return f"-o ControlMaster=no -o ControlPath={control_path}"
 
-def parse_config_from_output(output, hostname):
+
+def parse_config_from_output(output, hostname, marker):
     """Extract configuration from show running-config output
     
     Args:
         output: Raw output from expect script
         hostname: Switch hostname to filter prompt lines
+        marker: Per-run nonce of the CONFIG_START_/CONFIG_END_ lines around the dump
     """
     
-    # Find config between markers
-    start_marker = "CONFIG_START_MARKER"
-    end_marker = "CONFIG_END_MARKER"
+    # Find config between markers (the nonce keeps config text from ever matching them)
+    start_marker = f"CONFIG_START_{marker}"
+    end_marker = f"CONFIG_END_{marker}"
     
     if start_marker in output and end_marker in output:
         start = output.index(start_marker) + len(start_marker)
         end = output.index(end_marker)
         config_section = output[start:end]
     else:
-        # Fallback: try to find config by patterns
+        # Fallback: filter the whole output
         config_section = output
     
-    # Clean up the config
-    lines = config_section.split('\n')
-    config_lines = []
-    in_config = False
-    
-    for line in lines:
-        # Skip empty lines and prompts
-        if not line.strip():
-            continue
-        # Use hostname parameter instead of hardcoded value
-        if line.strip().startswith(hostname):
-            continue
-        if 'show running-config' in line:
-            in_config = True
-            continue
-        if 'terminal length' in line:
-            continue
-            
-        if in_config:
-            # Stop at end of config (prompt line)
-            if line.strip().startswith(hostname):
-                break
-            config_lines.append(line.rstrip())
-    
-    return '\n'.join(config_lines)
+    # Keep every config line: drop blanks, prompts and the echoed commands in one pass
+    config_line_re = re.compile(
+        rf'^(?!\s*$|\s*{re.escape(hostname)}|.*show running-config|.*terminal length).*$',
+        re.MULTILINE
+    )
+    return '\n'.join(match.group(0).rstrip() for match in config_line_re.finditer(config_section))
+
+
+ERROR_MESSAGES = {
+    "ERROR_CONNECTION_FAILED": "Connection failed: No route to host",
+    "ERROR_CONNECTION_REFUSED": "Connection refused: SSH port not open",
+    "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
+    "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
+    "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
+    "ERROR_ENABLE_PASSWORD": "Enable password required",
+    "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
+    "ERROR_BACKUP_TIMEOUT": "Timeout during backup",
+    "ERROR_RESTORE_TIMEOUT": "Timeout during restore",
+    "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
+    "ERROR_NO_BACKUP": "No backup configuration exists on switch",
+}
+
+SSH_ERROR_MESSAGES = {
+    "No route to host": "Connection failed: No route to host",
+    "Connection refused": "Connection refused: SSH service not reachable",
+    "Connection timed out": "Connection timeout: Host not responding",
+    "Host is unreachable": "Host unreachable",
+    "Permission denied": "Authentication failed: Wrong username or password",
+}
+
+SUCCESS_MARKERS = (
+    "SUCCESS_BACKUP_COMPLETE",
+    "SUCCESS_RESTORE_COMPLETE",
+    "SUCCESS_CONFIG_RETRIEVED",
+    "SUCCESS_COMPLETE",
+    # Fallback: the switch confirmed the save even if our marker got lost
+    "Saving user config OK!",
+)
+
+# One alternation per table: a single pass over the output instead of one scan per marker
+ERROR_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in ERROR_MESSAGES))
+SSH_ERROR_RE = re.compile("|".join(re.escape(error) for error in SSH_ERROR_MESSAGES))
+SUCCESS_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in SUCCESS_MARKERS))
 
 
 def analyze_output(stdout, stderr):
     """Analyze expect output for errors"""
     
-    error_patterns = {
-        "ERROR_CONNECTION_FAILED": "Connection failed: No route to host",
-        "ERROR_CONNECTION_REFUSED": "Connection refused: SSH port not open",
-        "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
-        "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
-        "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
-        "ERROR_ENABLE_PASSWORD": "Enable password required",
-        "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
-        "ERROR_BACKUP_TIMEOUT": "Timeout during backup",
-        "ERROR_RESTORE_TIMEOUT": "Timeout during restore",
-        "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
-        "ERROR_NO_BACKUP": "No backup configuration exists on switch",
-    }
-    
-    ssh_errors = {
-        "No route to host": "Connection failed: No route to host",
-        "Connection refused": "Connection refused: SSH service not reachable",
-        "Connection timed out": "Connection timeout: Host not responding",
-        "Host is unreachable": "Host unreachable",
-        "Permission denied": "Authentication failed: Wrong username or password",
-    }
-    
     combined = stdout + stderr
     
-    for error_key, error_msg in error_patterns.items():
-        if error_key in combined:
-            return False, error_msg
-    
-    for ssh_error, error_msg in ssh_errors.items():
-        if ssh_error in combined:
-            return False, error_msg
+    error_match = ERROR_MARKER_RE.search(combined)
+    if error_match:
+        return False, ERROR_MESSAGES[error_match.group(0)]
     
-    success_markers = ["SUCCESS_BACKUP_COMPLETE", "SUCCESS_RESTORE_COMPLETE", "SUCCESS_CONFIG_RETRIEVED", "SUCCESS_COMPLETE"]
-    for marker in success_markers:
-        if marker in combined:
-            return True, None
+    ssh_match = SSH_ERROR_RE.search(combined)
+    if ssh_match:
+        return False, SSH_ERROR_MESSAGES[ssh_match.group(0)]
     
-    # Fallback check
-    if "Saving user config OK!" in combined:
+    if SUCCESS_MARKER_RE.search(combined):
         return True, None
     
     return False, "Unknown error - check stdout"
 
 
-def run_expect_script(script_content, timeout=120):
-    """Run an expect script and return the result"""
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.exp', delete=False) as f:
-        f.write(script_content)
-        script_path = f.name
-    
-    try:
-        os.chmod(script_path, 0o700)
-        result = subprocess.run(
-            [script_path],
-            capture_output=True,
-            text=True,
-            timeout=timeout
-        )
-        return result.stdout, result.stderr, result.returncode
-    finally:
-        if os.path.exists(script_path):
-            os.unlink(script_path)
+def script_env(password):
+    """Environment for the expect process, carrying the password the script sends"""
+    return dict(os.environ, TP_PASSWORD=password)
+
+
+def run_expect_script(script_content, timeout=120, env=None):
+    """Run an expect script (piped to 'expect -f -', no temp file) and return the result"""
+    result = subprocess.run(
+        ['expect', '-f', '-'],
+        input=script_content,
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+        env=env
+    )
+    return result.stdout, result.stderr, result.returncode
 
 
 def main():
@@ -732,6 +589,7 @@ def main():
             backup_dir=dict(type='str', required=False, default='./backups'),
             backup_file=dict(type='str', required=False),
             config_file=dict(type='str', required=False),
+            control_persist=dict(type='int', required=False, default=0),
         ),
         supports_check_mode=False
     )
@@ -744,13 +602,29 @@ def main():
     backup_dir = module.params['backup_dir']
     backup_file = module.params['backup_file']
     config_file = module.params['config_file']
+    control_persist = module.params['control_persist']
+    
+    module.get_bin_path('expect', required=True)
+    
+    # Fail fast on an unreachable switch instead of waiting out the expect timeouts
+    probe_error = probe_port(host, 22)
+    if probe_error:
+        module.fail_json(msg=f"SSH port 22 on {host} not reachable: {probe_error}", host=host)
+    
+    # Same master socket as the batch VLAN modules: with control_persist this task
+    # leaves it open for later tasks, otherwise an open one is only reused
+    control_dir = os.path.expanduser('~/.ansible/cp')
+    if control_persist > 0:
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    mux_options = get_ssh_mux_options(os.path.join(control_dir, 'tp_link-%r@%h:%p'), control_persist)
+    env = script_env(password)
     
     # === ACTION: backup_switch ===
     if action == 'backup_switch':
-        script = create_backup_switch_script(host, username, password, hostname)
+        script = create_backup_switch_script(host, username, hostname, mux_options)
         
         try:
-            stdout, stderr, rc = run_expect_script(script, timeout=60)
+            stdout, stderr, rc = run_expect_script(script, timeout=60, env=env)
         except subprocess.TimeoutExpired:
             module.fail_json(msg="Timeout during backup on switch", host=host)
         
@@ -785,11 +659,12 @@ def main():
         
         backup_path = os.path.join(backup_dir, backup_file)
         
-        # Get running-config
-        script = create_show_config_script(host, username, password, hostname)
+        # Get running-config; the markers carry a random nonce so no config line can look like one
+        config_marker = uuid.uuid4().hex[:8]
+        script = create_show_config_script(host, username, hostname, mux_options, config_marker)
         
         try:
-            stdout, stderr, rc = run_expect_script(script, timeout=120)
+            stdout, stderr, rc = run_expect_script(script, timeout=120, env=env)
         except subprocess.TimeoutExpired:
             module.fail_json(msg="Timeout retrieving configuration", host=host)
         
@@ -798,7 +673,7 @@ def main():
             module.fail_json(msg=f"Backup failed: {error_msg}", host=host, stdout=stdout)
         
         # Parse and save config (use hostname parameter)
-        config = parse_config_from_output(stdout, hostname)
+        config = parse_config_from_output(stdout, hostname, config_marker)
         
         if not config or len(config) < 50:
             module.fail_json(
@@ -828,10 +703,10 @@ def main():
     
     # === ACTION: restore_switch ===
     elif action == 'restore_switch':
-        script = create_restore_switch_script(host, username, password, hostname)
+        script = create_restore_switch_script(host, username, hostname, mux_options)
         
         try:
-            stdout, stderr, rc = run_expect_script(script, timeout=60)
+            stdout, stderr, rc = run_expect_script(script, timeout=60, env=env)
         except subprocess.TimeoutExpired:
             module.fail_json(msg="Timeout during restore", host=host)
         
@@ -858,27 +733,20 @@ def main():
         if not os.access(config_file, os.R_OK):
             module.fail_json(msg=f"No read permission for config file: {config_file}")
         
-        # Read config file
+        # Read config file line by line, keeping commands only (skip comments and empty lines)
         try:
             with open(config_file, 'r') as f:
-                config_content = f.read()
+                config_commands = [line for line in (raw.strip() for raw in f) if line and line[0] not in '!#']
         except IOError as e:
             module.fail_json(msg=f"Failed to read config file: {str(e)}")
         
-        # Parse commands (skip comments and empty lines)
-        config_commands = []
-        for line in config_content.split('\n'):
-            line = line.strip()
-            if line and not line.startswith('!') and not line.startswith('#'):
-                config_commands.append(line)
-        
         if not config_commands:
             module.fail_json(msg="No configuration commands found in file")
         
-        script = create_restore_local_script(host, username, password, hostname, config_commands)
+        script = create_restore_local_script(host, username, hostname, config_commands, mux_options)
         
         try:
-            stdout, stderr, rc = run_expect_script(script, timeout=180)
+            stdout, stderr, rc = run_expect_script(script, timeout=180, env=env)
         except subprocess.TimeoutExpired:
             module.fail_json(msg="Timeout during restore from local file", host=host)
         
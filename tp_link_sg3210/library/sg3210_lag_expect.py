@@ -23,13 +23,19 @@ Parameters:
     lacp_mode: LACP mode - active, passive, on (default: active)
     state: present or absent (default: present)
     max_port: Maximum port number on switch (default: 10)
+    control_persist: Seconds to keep the SSH connection open for later tasks (default: 0)
 """
 
 from ansible.module_utils.basic import AnsibleModule
+import atexit
 import subprocess
 import tempfile
 import os
 import re
+import shutil
+import string
+import threading
+import time
 
 
 DOCUMENTATION = r'''
@@ -79,6 +85,14 @@ options:
         required: false
         default: 10
         type: int
+    control_persist:
+        description:
+            - Seconds to keep the SSH master connection open after the task, so later
+              tasks against the same switch and user reuse it instead of logging in again
+            - 0 closes the connection when the module finishes
+        required: false
+        default: 0
+        type: int
 '''
 
 EXAMPLES = r'''
@@ -119,17 +133,19 @@ def validate_lag_config(module, lag_id, ports, max_port):
     if len(ports) < MIN_PORTS_IN_LAG:
         module.fail_json(msg=f"At least {MIN_PORTS_IN_LAG} ports required for LAG, got {len(ports)}")
     
-    seen_ports = set()
-    for port in ports:
-        if port in seen_ports:
-            module.fail_json(msg=f"Duplicate port {port} in ports list")
-        seen_ports.add(port)
-    
     for port in ports:
         if not isinstance(port, int):
             module.fail_json(msg=f"Port must be an integer, got {type(port).__name__}")
-        if not MIN_PORT <= port <= max_port:
-            module.fail_json(msg=f"Port {port} must be between {MIN_PORT} and {max_port}")
+    
+    # Set and range membership; every offending port is reported at once
+    unique_ports = set(ports)
+    if len(unique_ports) != len(ports):
+        duplicates = sorted(port for port in unique_ports if ports.count(port) > 1)
+        module.fail_json(msg=f"Duplicate ports {duplicates} in ports list")
+    
+    invalid_ports = sorted(unique_ports - set(range(MIN_PORT, max_port + 1)))
+    if invalid_ports:
+        module.fail_json(msg=f"Ports {invalid_ports} must be between {MIN_PORT} and {max_port}")
 
 
 # =============================================================================
@@ -246,308 +262,390 @@ def calculate_lag_diff(current_lags, lag_id, desired_ports, desired_mode, state)
 # EXPECT SCRIPT GENERATORS
 # =============================================================================
 
-def create_get_config_script(host, username, password, hostname):
-    """Generate expect script to get running-config"""
-    
-    script = f'''#!/usr/bin/expect -f
-set timeout 60
-log_user 1
+def get_ssh_mux_options(control_path, control_persist):
+    """ssh options that let all expect runs share one SSH master connection"""
+    return f"-o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist={control_persist}"
 
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{host}
 
-expect {{
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to host {host}"
+# Scripts are parsed once at import; the create_*_script() functions only substitute values
+GET_CONFIG_SCRIPT_TEMPLATE = string.Template(r'''set timeout 60
+log_user 0
+
+set logged_in 0
+spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 ${mux_options} ${username}@${host}
+
+expect {
+    "No route to host" {
+        puts "ERROR_CONNECTION_FAILED: No route to host ${host}"
         exit 1
-    }}
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Connection refused by {host}"
+    }
+    "Connection refused" {
+        puts "ERROR_CONNECTION_REFUSED: Connection refused by ${host}"
         exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {host} timed out"
+    }
+    "Connection timed out" {
+        puts "ERROR_CONNECTION_TIMEOUT: Connection to ${host} timed out"
         exit 1
-    }}
-    "Host is unreachable" {{
-        puts "ERROR_HOST_UNREACHABLE: Host {host} is unreachable"
+    }
+    "Host is unreachable" {
+        puts "ERROR_HOST_UNREACHABLE: Host ${host} is unreachable"
         exit 1
-    }}
-    "password:" {{
-        send "{password}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
+    }
+    "password:" {
+        send "${password}\r"
+    }
+    "${hostname}>" {
+        # Multiplexed session - no password prompt
+        set logged_in 1
+    }
+    timeout {
+        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to ${host}"
         exit 1
-    }}
-}}
+    }
+}
 
-expect {{
-    "Permission denied" {{
-        puts "ERROR_AUTH_FAILED: Authentication failed"
-        exit 1
-    }}
-    "{hostname}>" {{}}
-    timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout"
-        exit 1
-    }}
-}}
+if {!$$logged_in} {
+    expect {
+        "Permission denied" {
+            puts "ERROR_AUTH_FAILED: Authentication failed"
+            exit 1
+        }
+        "${hostname}>" {}
+        timeout {
+            puts "ERROR_AUTH_FAILED: Login timeout"
+            exit 1
+        }
+    }
+}
 
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
+send "enable\r"
+expect {
+    "${hostname}#" {}
+    "Password:" {
         puts "ERROR_ENABLE_PASSWORD: Enable password required"
         exit 1
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
         exit 1
-    }}
-}}
+    }
+}
 
-send "terminal length 0\\r"
-expect "{hostname}#"
+send "terminal length 0\r"
+expect "${hostname}#"
 
-send "show running-config\\r"
-expect "{hostname}#"
+# Only the config dump is mirrored to stdout for parse_running_config_lags()
+log_user 1
+send "show running-config\r"
+expect "${hostname}#"
+log_user 0
 
-send "exit\\r"
-expect "{hostname}>"
-send "exit\\r"
+send "exit\r"
+expect "${hostname}>"
+send "exit\r"
 expect eof
 
 puts "SUCCESS_GET_CONFIG"
-'''
-    return script
+''')
 
 
-def create_lag_config_script(host, username, password, hostname, lag_id, diff, lacp_mode):
-    """Generate expect script for LAG configuration based on calculated diff"""
+def create_get_config_script(host, username, password, hostname, mux_options):
+    """Generate expect script to get running-config"""
     
-    port_commands = ""
-    
-    # Remove ports first
-    for port in diff.get('ports_to_remove', []):
-        port_commands += f'''
-# === Remove PORT {port} from LAG ===
-send "interface gigabitEthernet 1/0/{port}\\r"
-expect {{
-    "{hostname}(config-if)#" {{}}
-    "Invalid" {{
-        puts "ERROR_INVALID_PORT: Invalid port number {port}"
+    return GET_CONFIG_SCRIPT_TEMPLATE.substitute(
+        host=host, username=username, password=password, hostname=hostname, mux_options=mux_options
+    )
+
+
+# Per port, interface / channel-group / exit go out in one send and
+# the three prompts are then matched in order
+REMOVE_PORT_TEMPLATE = string.Template(r'''
+# === Remove PORT ${port} from LAG ===
+send "interface gigabitEthernet 1/0/${port}\rno channel-group\rexit\r"
+expect {
+    "${hostname}(config-if)#" {}
+    "Invalid" {
+        puts "ERROR_INVALID_PORT: Invalid port number ${port}"
         exit 1
-    }}
-    timeout {{
-        puts "ERROR_PORT_TIMEOUT: Timeout entering interface config for port {port}"
+    }
+    timeout {
+        puts "ERROR_PORT_TIMEOUT: Timeout entering interface config for port ${port}"
         exit 1
-    }}
-}}
-send "no channel-group\\r"
-expect {{
-    "{hostname}(config-if)#" {{}}
-    "Invalid" {{
-        puts "WARNING_NO_LAG: Port {port} was not in a LAG"
-    }}
-    timeout {{
-        puts "ERROR_LAG_TIMEOUT: Timeout removing port {port} from LAG"
+    }
+}
+expect {
+    "${hostname}(config-if)#" {}
+    "Invalid" {
+        puts "WARNING_NO_LAG: Port ${port} was not in a LAG"
+    }
+    timeout {
+        puts "ERROR_LAG_TIMEOUT: Timeout removing port ${port} from LAG"
         exit 1
-    }}
-}}
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
-    
-    # Add ports
-    for port in diff.get('ports_to_add', []):
-        port_commands += f'''
-# === Add PORT {port} to LAG {lag_id} ===
-send "interface gigabitEthernet 1/0/{port}\\r"
-expect {{
-    "{hostname}(config-if)#" {{}}
-    "Invalid" {{
-        puts "ERROR_INVALID_PORT: Invalid port number {port}"
+    }
+}
+expect "${hostname}(config)#"
+''')
+
+ADD_PORT_TEMPLATE = string.Template(r'''
+# === Add PORT ${port} to LAG ${lag_id} ===
+send "interface gigabitEthernet 1/0/${port}\rchannel-group ${lag_id} mode ${lacp_mode}\rexit\r"
+expect {
+    "${hostname}(config-if)#" {}
+    "Invalid" {
+        puts "ERROR_INVALID_PORT: Invalid port number ${port}"
         exit 1
-    }}
-    timeout {{
-        puts "ERROR_PORT_TIMEOUT: Timeout entering interface config for port {port}"
+    }
+    timeout {
+        puts "ERROR_PORT_TIMEOUT: Timeout entering interface config for port ${port}"
         exit 1
-    }}
-}}
-send "channel-group {lag_id} mode {lacp_mode}\\r"
-expect {{
-    "{hostname}(config-if)#" {{}}
-    "already a member" {{
-        puts "WARNING_PORT_IN_LAG: Port {port} is already a member of another LAG"
-    }}
-    "Invalid" {{
-        puts "ERROR_LAG_COMMAND: Invalid LAG command for port {port}"
+    }
+}
+expect {
+    "${hostname}(config-if)#" {}
+    "already a member" {
+        puts "WARNING_PORT_IN_LAG: Port ${port} is already a member of another LAG"
+    }
+    "Invalid" {
+        puts "ERROR_LAG_COMMAND: Invalid LAG command for port ${port}"
         exit 1
-    }}
-    "Error" {{
-        puts "ERROR_LAG_FAILED: Failed to add port {port} to LAG {lag_id}"
+    }
+    "Error" {
+        puts "ERROR_LAG_FAILED: Failed to add port ${port} to LAG ${lag_id}"
         exit 1
-    }}
-    timeout {{
-        puts "ERROR_LAG_TIMEOUT: Timeout adding port {port} to LAG {lag_id}"
+    }
+    timeout {
+        puts "ERROR_LAG_TIMEOUT: Timeout adding port ${port} to LAG ${lag_id}"
         exit 1
-    }}
-}}
-send "exit\\r"
-expect "{hostname}(config)#"
-'''
-    
-    script = f'''#!/usr/bin/expect -f
-set timeout 30
-log_user 1
+    }
+}
+expect "${hostname}(config)#"
+''')
+
+LAG_CONFIG_SCRIPT_TEMPLATE = string.Template(r'''set timeout 30
+log_user 0
 
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{host}
+set logged_in 0
+spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 ${mux_options} ${username}@${host}
 
-expect {{
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to host {host}"
+expect {
+    "No route to host" {
+        puts "ERROR_CONNECTION_FAILED: No route to host ${host}"
         exit 1
-    }}
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Connection refused by {host}"
+    }
+    "Connection refused" {
+        puts "ERROR_CONNECTION_REFUSED: Connection refused by ${host}"
         exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {host} timed out"
+    }
+    "Connection timed out" {
+        puts "ERROR_CONNECTION_TIMEOUT: Connection to ${host} timed out"
         exit 1
-    }}
-    "Host is unreachable" {{
-        puts "ERROR_HOST_UNREACHABLE: Host {host} is unreachable"
+    }
+    "Host is unreachable" {
+        puts "ERROR_HOST_UNREACHABLE: Host ${host} is unreachable"
         exit 1
-    }}
-    "password:" {{
-        send "{password}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {host}"
+    }
+    "password:" {
+        send "${password}\r"
+    }
+    "${hostname}>" {
+        # Multiplexed session - no password prompt
+        set logged_in 1
+    }
+    timeout {
+        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to ${host}"
         exit 1
-    }}
-}}
+    }
+}
 
-expect {{
-    "Permission denied" {{
-        puts "ERROR_AUTH_FAILED: Authentication failed"
-        exit 1
-    }}
-    "{hostname}>" {{}}
-    timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout"
-        exit 1
-    }}
-}}
+if {!$$logged_in} {
+    expect {
+        "Permission denied" {
+            puts "ERROR_AUTH_FAILED: Authentication failed"
+            exit 1
+        }
+        "${hostname}>" {}
+        timeout {
+            puts "ERROR_AUTH_FAILED: Login timeout"
+            exit 1
+        }
+    }
+}
 
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
+send "enable\r"
+expect {
+    "${hostname}#" {}
+    "Password:" {
         puts "ERROR_ENABLE_PASSWORD: Enable password required"
         exit 1
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
         exit 1
-    }}
-}}
+    }
+}
 
-send "configure\\r"
-expect {{
-    "{hostname}(config)#" {{}}
-    timeout {{
+send "configure\r"
+expect {
+    "${hostname}(config)#" {}
+    timeout {
         puts "ERROR_CONFIG_TIMEOUT: Timeout entering config mode"
         exit 1
-    }}
-}}
+    }
+}
 
 # === LAG CONFIGURATION ===
-{port_commands}
+${port_commands}
 
 # === SAVE CONFIG ===
-send "exit\\r"
-expect "{hostname}#"
-send "copy running-config startup-config\\r"
+send "exit\r"
+expect "${hostname}#"
+send "copy running-config startup-config\r"
 
-expect {{
-    "Saving user config OK!" {{
+expect {
+    "Saving user config OK!" {
         puts "SUCCESS_CONFIG_SAVED"
-    }}
-    "Succeed" {{
+    }
+    "Succeed" {
         puts "SUCCESS_CONFIG_SAVED"
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_SAVE_TIMEOUT: Timeout saving configuration"
         exit 1
-    }}
-}}
+    }
+}
 
-send "exit\\r"
-expect "{hostname}>"
-send "exit\\r"
+send "exit\r"
+expect "${hostname}>"
+send "exit\r"
 expect eof
 
 puts "SUCCESS_COMPLETE"
-'''
-    return script
+''')
+
+
+def create_lag_config_script(host, username, password, hostname, lag_id, diff, lacp_mode, mux_options):
+    """Generate expect script for LAG configuration based on calculated diff"""
+    
+    # Remove ports first, then add ports (or reconfigure for mode change)
+    port_commands = "".join(
+        [REMOVE_PORT_TEMPLATE.substitute(port=port, hostname=hostname)
+         for port in diff.get('ports_to_remove', [])]
+        + [ADD_PORT_TEMPLATE.substitute(port=port, hostname=hostname, lag_id=lag_id, lacp_mode=lacp_mode)
+           for port in diff.get('ports_to_add', [])]
+    )
+    
+    return LAG_CONFIG_SCRIPT_TEMPLATE.substitute(
+        host=host, username=username, password=password, hostname=hostname,
+        mux_options=mux_options, port_commands=port_commands
+    )
+
+
+ERROR_MESSAGES = {
+    "ERROR_CONNECTION_FAILED": "Connection failed: No route to host",
+    "ERROR_CONNECTION_REFUSED": "Connection refused: SSH port not open",
+    "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
+    "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
+    "ERROR_DNS_FAILED": "DNS resolution failed",
+    "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
+    "ERROR_ENABLE_PASSWORD": "Enable password required",
+    "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
+    "ERROR_CONFIG_TIMEOUT": "Timeout entering config mode",
+    "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
+    "ERROR_PORT_TIMEOUT": "Timeout during port configuration",
+    "ERROR_INVALID_PORT": "Invalid port number",
+    "ERROR_LAG_COMMAND": "Invalid LAG command",
+    "ERROR_LAG_FAILED": "LAG configuration failed",
+    "ERROR_LAG_TIMEOUT": "Timeout during LAG configuration",
+}
+
+SUCCESS_MARKERS = (
+    "SUCCESS_COMPLETE",
+    "SUCCESS_CONFIG_SAVED",
+    "SUCCESS_GET_CONFIG",
+    # Fallback: the switch confirmed the save even if our marker got lost
+    "Saving user config OK!",
+)
+
+# One alternation per table: a single pass over the output instead of one scan per marker
+ERROR_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in ERROR_MESSAGES))
+SUCCESS_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in SUCCESS_MARKERS))
 
 
 def analyze_output(stdout, stderr):
     """Analyze expect output for errors"""
     
-    error_patterns = {
-        "ERROR_CONNECTION_FAILED": "Connection failed: No route to host",
-        "ERROR_CONNECTION_REFUSED": "Connection refused: SSH port not open",
-        "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
-        "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
-        "ERROR_DNS_FAILED": "DNS resolution failed",
-        "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
-        "ERROR_ENABLE_PASSWORD": "Enable password required",
-        "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
-        "ERROR_CONFIG_TIMEOUT": "Timeout entering config mode",
-        "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
-        "ERROR_PORT_TIMEOUT": "Timeout during port configuration",
-        "ERROR_INVALID_PORT": "Invalid port number",
-        "ERROR_LAG_COMMAND": "Invalid LAG command",
-        "ERROR_LAG_FAILED": "LAG configuration failed",
-        "ERROR_LAG_TIMEOUT": "Timeout during LAG configuration",
-    }
-    
     combined = stdout + stderr
     
-    for error_key, error_msg in error_patterns.items():
-        if error_key in combined:
-            return False, error_msg
+    error_match = ERROR_MARKER_RE.search(combined)
+    if error_match:
+        return False, ERROR_MESSAGES[error_match.group(0)]
     
-    if "SUCCESS_COMPLETE" in combined or "SUCCESS_CONFIG_SAVED" in combined or "SUCCESS_GET_CONFIG" in combined:
-        return True, None
-    
-    if "Saving user config OK!" in combined:
+    if SUCCESS_MARKER_RE.search(combined):
         return True, None
     
     return False, "Unknown error - check stdout"
 
 
+STOP_MARKERS = ('ERROR_',)
+
+
 def run_expect_script(script_content, timeout=120):
-    """Run an expect script and return the result"""
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.exp', delete=False) as f:
-        f.write(script_content)
-        script_path = f.name
+    """
+    Run an expect script (piped to 'expect -f -', no temp file) and return the result.
     
+    Output is read line by line while the script runs, and the script is stopped
+    at the first STOP_MARKERS line instead of waiting for it to wind down.
+    stderr is merged into stdout, so the returned stderr is always empty.
+    """
+    proc = subprocess.Popen(
+        ['expect', '-f', '-'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        # Decoded once per line; a stray non-UTF-8 byte must not abort the read
+        errors='replace'
+    )
+    # The script fits in the pipe buffer; expect may exit before reading all of it
+    try:
+        proc.stdin.write(script_content)
+        proc.stdin.close()
+    except OSError:
+        pass
+    
+    # Reading blocks, so the overall timeout is enforced by killing the process
+    deadline = time.monotonic() + timeout
+    killer = threading.Timer(timeout, proc.kill)
+    killer.start()
+    lines = []
     try:
-        os.chmod(script_path, 0o700)
-        result = subprocess.run(
-            [script_path],
+        for line in proc.stdout:
+            lines.append(line)
+            if line.startswith(STOP_MARKERS):
+                proc.terminate()
+                break
+        proc.wait()
+    finally:
+        killer.cancel()
+        proc.stdout.close()
+    
+    # Partial output is kept on timeout
+    if time.monotonic() >= deadline:
+        return "".join(lines), "", -1, True
+    return "".join(lines), "", proc.returncode, False
+
+
+def close_ssh_master(host, username, control_path, control_dir):
+    """Stop the shared SSH master connection and remove its socket directory"""
+    try:
+        subprocess.run(
+            ['ssh', '-o', f'ControlPath={control_path}', '-O', 'exit', f'{username}@{host}'],
             capture_output=True,
-            text=True,
-            timeout=timeout
+            timeout=10
         )
-        return result.stdout, result.stderr, result.returncode
-    finally:
-        if os.path.exists(script_path):
-            os.unlink(script_path)
+    except (OSError, subprocess.SubprocessError):
+        pass
+    shutil.rmtree(control_dir, ignore_errors=True)
 
 
 def main():
@@ -564,6 +662,7 @@ def main():
             state=dict(type='str', required=False, default='present',
                       choices=['present', 'absent']),
             max_port=dict(type='int', required=False, default=10),
+            control_persist=dict(type='int', required=False, default=0),
         ),
         supports_check_mode=True
     )
@@ -577,19 +676,37 @@ def main():
     lacp_mode = module.params['lacp_mode']
     state = module.params['state']
     max_port = module.params['max_port']
+    control_persist = module.params['control_persist']
     
     validate_lag_config(module, lag_id, ports, max_port)
     
+    module.get_bin_path('expect', required=True)
+    
+    # Get-config and configure phase share one SSH connection (OpenSSH multiplexing).
+    # With control_persist the master outlives this task and is reused by later
+    # tasks against the same switch/user.
+    if control_persist > 0:
+        control_dir = os.path.expanduser('~/.ansible/cp')
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+        control_path = os.path.join(control_dir, 'tp_link-%r@%h:%p')
+        mux_options = get_ssh_mux_options(control_path, control_persist)
+    else:
+        control_dir = tempfile.mkdtemp(prefix='tp_link_ssh_')
+        control_path = os.path.join(control_dir, '%r@%h:%p')
+        mux_options = get_ssh_mux_options(control_path, 30)
+        atexit.register(close_ssh_master, host, username, control_path, control_dir)
+    
     # === STEP 1: Get current configuration ===
-    get_config_script = create_get_config_script(host, username, password, hostname)
+    get_config_script = create_get_config_script(host, username, password, hostname, mux_options)
     
     try:
-        stdout, stderr, returncode = run_expect_script(get_config_script, timeout=60)
-    except subprocess.TimeoutExpired:
-        module.fail_json(msg="Timeout getting current configuration", host=host)
+        stdout, stderr, returncode, timed_out = run_expect_script(get_config_script, timeout=60)
     except Exception as e:
         module.fail_json(msg=f"Error getting configuration: {str(e)}", host=host)
     
+    if timed_out:
+        module.fail_json(msg="Timeout getting current configuration", host=host, stdout=stdout)
+    
     success, error_msg = analyze_output(stdout, stderr)
     if not success:
         module.fail_json(
@@ -635,16 +752,17 @@ def main():
     
     # === STEP 6: Apply changes ===
     config_script = create_lag_config_script(
-        host, username, password, hostname, lag_id, diff, lacp_mode
+        host, username, password, hostname, lag_id, diff, lacp_mode, mux_options
     )
     
     try:
-        stdout, stderr, returncode = run_expect_script(config_script, timeout=120)
-    except subprocess.TimeoutExpired:
-        module.fail_json(msg="Total timeout exceeded (120s)", host=host)
+        stdout, stderr, returncode, timed_out = run_expect_script(config_script, timeout=120)
     except Exception as e:
         module.fail_json(msg=f"Unexpected error: {str(e)}", host=host)
     
+    if timed_out:
+        module.fail_json(msg="Total timeout exceeded (120s)", host=host, stdout=stdout)
+    
     success, error_msg = analyze_output(stdout, stderr)
     
     if not success:
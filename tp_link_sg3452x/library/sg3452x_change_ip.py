@@ -30,10 +30,24 @@ Example:
 
 from ansible.module_utils.basic import AnsibleModule
 import subprocess
-import tempfile
 import os
+import re
+import socket
+import string
+import threading
+import time
 import ipaddress
 
+# Same socket the batch VLAN modules keep open with control_persist
+CONTROL_PATH = '~/.ansible/cp/tp_link-%r@%h:%p'
+
+# A switch on the management network answers a TCP connect well within this
+SSH_PROBE_TIMEOUT = 5
+
+# Bounds for the per-prompt expect timeout derived from the measured connect time
+MIN_SCRIPT_TIMEOUT = 20
+MAX_SCRIPT_TIMEOUT = 120
+
 DOCUMENTATION = r'''
 module: tp_link_change_ip
 short_description: Change IP address of TP-Link SG3452X via SSH
@@ -42,6 +56,8 @@ description:
     - Changes IP address, netmask, and gateway
     - Saves configuration BEFORE IP change
     - Handles expected connection drop after IP change
+    - Reuses an SSH master connection left open by the batch VLAN modules
+      (control_persist) and closes it once the IP has changed
 options:
     current_ip:
         description: Current IP address of the switch
@@ -90,252 +106,290 @@ EXAMPLES = r'''
 '''
 
 
-def create_change_ip_script(current_ip, username, password, 
-                             new_ip, new_netmask, new_gateway, hostname):
-    """Generate expect script for IP change via SSH
-    
-    Strategy: Save config BEFORE changing IP, then change IP.
-    Connection will drop after IP change - this is expected and OK.
-    """
-    
-    script = f'''#!/usr/bin/expect -f
-set timeout 30
+# Characters Tcl would substitute or use for brace matching inside the script
+TCL_SPECIAL_CHARS_RE = re.compile(r'([\\\[\]$"{}])')
+
+
+def tcl_escape(value):
+    """Backslash-escape a value so Tcl uses it literally (e.g. a password with $ or {)"""
+    return TCL_SPECIAL_CHARS_RE.sub(r'\\\1', value)
+
+
+# Parsed once at import; create_change_ip_script() only substitutes the values
+CHANGE_IP_SCRIPT_TEMPLATE = string.Template(r'''set timeout ${script_timeout}
 log_user 1
 
 # === CONNECTION PHASE ===
-spawn ssh -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 {username}@{current_ip}
-
-expect {{
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to host {current_ip}"
+# ControlMaster=no: use an existing master socket if there is one, never start one
+# (a master would outlive the IP change pointing at the old address)
+set logged_in 0
+spawn ssh -C -o StrictHostKeyChecking=no -o PubkeyAuthentication=no -o ConnectTimeout=20 -o ControlMaster=no -o ControlPath=${control_path} ${username}@${current_ip}
+
+expect {
+    "No route to host" {
+        puts "ERROR_CONNECTION_FAILED: No route to host ${current_ip}"
         exit 1
-    }}
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Connection refused by {current_ip}"
+    }
+    "Connection refused" {
+        puts "ERROR_CONNECTION_REFUSED: Connection refused by ${current_ip}"
         exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {current_ip} timed out"
+    }
+    "Connection timed out" {
+        puts "ERROR_CONNECTION_TIMEOUT: Connection to ${current_ip} timed out"
         exit 1
-    }}
-    "Host is unreachable" {{
-        puts "ERROR_HOST_UNREACHABLE: Host {current_ip} is unreachable"
+    }
+    "Host is unreachable" {
+        puts "ERROR_HOST_UNREACHABLE: Host ${current_ip} is unreachable"
         exit 1
-    }}
-    "Name or service not known" {{
-        puts "ERROR_DNS_FAILED: Could not resolve hostname {current_ip}"
+    }
+    "Name or service not known" {
+        puts "ERROR_DNS_FAILED: Could not resolve hostname ${current_ip}"
         exit 1
-    }}
-    "password:" {{
-        send "{password}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {current_ip}"
+    }
+    "password:" {
+        send "${password}\r"
+    }
+    "${hostname}>" {
+        # Multiplexed session - no password prompt
+        set logged_in 1
+    }
+    timeout {
+        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to ${current_ip}"
         exit 1
-    }}
-}}
+    }
+}
 
 # === LOGIN PHASE ===
-expect {{
-    "Permission denied" {{
-        puts "ERROR_AUTH_FAILED: Authentication failed - wrong username or password"
-        exit 1
-    }}
-    "Access denied" {{
-        puts "ERROR_AUTH_FAILED: Access denied - wrong username or password"
-        exit 1
-    }}
-    "{hostname}>" {{
-        # Login successful
-    }}
-    timeout {{
-        puts "ERROR_AUTH_FAILED: Login timeout - check username/password"
-        exit 1
-    }}
-}}
+if {!$$logged_in} {
+    expect {
+        "Permission denied" {
+            puts "ERROR_AUTH_FAILED: Authentication failed - wrong username or password"
+            exit 1
+        }
+        "Access denied" {
+            puts "ERROR_AUTH_FAILED: Access denied - wrong username or password"
+            exit 1
+        }
+        "${hostname}>" {
+            # Login successful
+        }
+        timeout {
+            puts "ERROR_AUTH_FAILED: Login timeout - check username/password"
+            exit 1
+        }
+    }
+}
+
+# Logged in: raw ssh errors were the only output worth mirroring, from here on
+# only the script's own markers are printed, not the CLI echo
+log_user 0
 
 # === ENABLE MODE ===
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
+send "enable\r"
+expect {
+    "${hostname}#" {}
+    "Password:" {
         puts "ERROR_ENABLE_PASSWORD: Enable password required but not provided"
         exit 1
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
         exit 1
-    }}
-}}
+    }
+}
 
 # === CONFIGURE MODE ===
-send "configure\\r"
-expect {{
-    "{hostname}(config)#" {{}}
-    timeout {{
+send "configure\r"
+expect {
+    "${hostname}(config)#" {}
+    timeout {
         puts "ERROR_CONFIG_TIMEOUT: Timeout entering config mode"
         exit 1
-    }}
-}}
+    }
+}
 
 # === CONFIGURE GATEWAY FIRST ===
 # (Gateway can be configured before IP change)
-send "ip default-gateway {new_gateway}\\r"
-expect {{
-    "{hostname}(config)#" {{}}
-    "Invalid" {{
+send "ip default-gateway ${new_gateway}\r"
+expect {
+    "${hostname}(config)#" {}
+    "Invalid" {
         puts "ERROR_INVALID_GATEWAY: Invalid gateway address"
         exit 1
-    }}
-    "Error" {{
+    }
+    "Error" {
         puts "ERROR_GATEWAY_CONFIG: Failed to configure gateway"
         exit 1
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_GATEWAY_TIMEOUT: Timeout configuring gateway"
         exit 1
-    }}
-}}
+    }
+}
 
 # === SAVE CONFIG BEFORE IP CHANGE ===
 # This is critical - save BEFORE changing IP so config persists even if connection drops
-send "exit\\r"
-expect "{hostname}#"
-
-send "copy running-config startup-config\\r"
-expect {{
-    "Saving user config OK!" {{
+# Leaving config mode cannot fail, so the save command follows in the same send
+send "exit\rcopy running-config startup-config\r"
+expect {
+    "Saving user config OK!" {
         puts "SUCCESS_GATEWAY_SAVED"
-    }}
-    "Succeed" {{
+    }
+    "Succeed" {
         puts "SUCCESS_GATEWAY_SAVED"
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_SAVE_TIMEOUT: Timeout saving gateway configuration"
         exit 1
-    }}
-}}
+    }
+}
 
 # === NOW CHANGE IP ADDRESS ===
 # After this, connection WILL drop - this is expected!
-send "configure\\r"
-expect "{hostname}(config)#"
-
-send "interface vlan 1\\r"
-expect {{
-    "{hostname}(config-if)#" {{}}
-    timeout {{
+# configure worked above already; only the final (config-if)# prompt is awaited
+send "configure\rinterface vlan 1\r"
+expect {
+    "${hostname}(config-if)#" {}
+    timeout {
         puts "ERROR_INTERFACE_TIMEOUT: Timeout entering interface config"
         exit 1
-    }}
-}}
+    }
+}
 
 puts "INFO_CHANGING_IP: About to change IP - connection will drop"
 
 # Change IP - expect connection to drop immediately or shortly after
-send "ip address {new_ip} {new_netmask}\\r"
+send "ip address ${new_ip} ${new_netmask}\r"
 
 # Short timeout - we expect this to fail/timeout because connection drops
 set timeout 5
-expect {{
-    "{hostname}(config-if)#" {{
+expect {
+    "${hostname}(config-if)#" {
         # Unexpected - IP didn't change yet? Try to save and exit
         puts "INFO_IP_COMMAND_ACCEPTED"
-        send "exit\\r"
-        expect "{hostname}(config)#"
-        send "exit\\r"
-        expect "{hostname}#"
-        send "copy running-config startup-config\\r"
-        expect {{
-            "Saving user config OK!" {{ puts "SUCCESS_CONFIG_SAVED" }}
-            "Succeed" {{ puts "SUCCESS_CONFIG_SAVED" }}
-            timeout {{ puts "WARNING_SAVE_TIMEOUT" }}
-        }}
-        send "exit\\r"
-    }}
-    eof {{
+        send "exit\r"
+        expect "${hostname}(config)#"
+        send "exit\r"
+        expect "${hostname}#"
+        send "copy running-config startup-config\r"
+        expect {
+            "Saving user config OK!" { puts "SUCCESS_CONFIG_SAVED" }
+            "Succeed" { puts "SUCCESS_CONFIG_SAVED" }
+            timeout { puts "WARNING_SAVE_TIMEOUT" }
+        }
+        send "exit\r"
+    }
+    eof {
         # Connection dropped - this is EXPECTED and SUCCESS
         puts "SUCCESS_IP_CHANGED_CONNECTION_DROPPED"
-    }}
-    timeout {{
+    }
+    timeout {
         # Timeout likely means connection dropped - this is SUCCESS
         puts "SUCCESS_IP_CHANGED_TIMEOUT"
-    }}
-    "Invalid" {{
+    }
+    "Invalid" {
         puts "ERROR_INVALID_IP: Invalid IP address or netmask"
         exit 1
-    }}
-    "Error" {{
+    }
+    "Error" {
         puts "ERROR_IP_CONFIG: Failed to configure IP address"
         exit 1
-    }}
-}}
+    }
+}
 
 puts "SUCCESS_COMPLETE"
-'''
+''')
+
+
+def create_change_ip_script(current_ip, username, password, 
+                             new_ip, new_netmask, new_gateway, hostname, control_path,
+                             script_timeout=30):
+    """Generate expect script for IP change via SSH
+    
+    Strategy: Save config BEFORE changing IP, then change IP.
+    Connection will drop after IP change - this is expected and OK.
+    """
     
-    return script
+    return CHANGE_IP_SCRIPT_TEMPLATE.substitute(
+        current_ip=current_ip,
+        username=tcl_escape(username),
+        password=tcl_escape(password),
+        new_ip=new_ip,
+        new_netmask=new_netmask,
+        new_gateway=new_gateway,
+        hostname=tcl_escape(hostname),
+        control_path=control_path,
+        script_timeout=script_timeout,
+    )
+
+
+# Error markers printed by the expect script, mapped to user-facing messages
+ERROR_MESSAGES = {
+    "ERROR_CONNECTION_FAILED": "Connection failed: No route to host",
+    "ERROR_CONNECTION_REFUSED": "Connection refused: SSH port not open",
+    "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
+    "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
+    "ERROR_DNS_FAILED": "DNS resolution failed",
+    "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
+    "ERROR_ENABLE_PASSWORD": "Enable password required",
+    "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
+    "ERROR_CONFIG_TIMEOUT": "Timeout entering config mode",
+    "ERROR_INTERFACE_TIMEOUT": "Timeout entering interface config",
+    "ERROR_INVALID_IP": "Invalid IP address or netmask",
+    "ERROR_IP_CONFIG": "Failed to configure IP address",
+    "ERROR_INVALID_GATEWAY": "Invalid gateway address",
+    "ERROR_GATEWAY_CONFIG": "Failed to configure gateway",
+    "ERROR_GATEWAY_TIMEOUT": "Timeout configuring gateway",
+    "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
+}
+
+# Raw ssh errors, only meaningful before the IP change started
+SSH_ERROR_MESSAGES = {
+    "No route to host": "Connection failed: No route to host",
+    "Connection refused": "Connection refused: SSH service not reachable",
+    "Connection timed out": "Connection timeout: Host not responding",
+    "Host is unreachable": "Host unreachable",
+    "Permission denied": "Authentication failed: Wrong username or password",
+}
+
+SUCCESS_MARKERS = (
+    "SUCCESS_COMPLETE",
+    "SUCCESS_IP_CHANGED_CONNECTION_DROPPED",
+    "SUCCESS_IP_CHANGED_TIMEOUT",
+    "SUCCESS_CONFIG_SAVED",
+    "SUCCESS_GATEWAY_SAVED",
+)
+
+# One alternation per table: a single scan of the output instead of one per entry
+ERROR_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in ERROR_MESSAGES))
+SSH_ERROR_RE = re.compile("|".join(re.escape(error) for error in SSH_ERROR_MESSAGES))
+SUCCESS_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in SUCCESS_MARKERS))
 
 
 def analyze_output(stdout, stderr):
     """Analyze expect output for errors and return appropriate message"""
     
-    error_patterns = {
-        "ERROR_CONNECTION_FAILED": "Connection failed: No route to host",
-        "ERROR_CONNECTION_REFUSED": "Connection refused: SSH port not open",
-        "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
-        "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
-        "ERROR_DNS_FAILED": "DNS resolution failed",
-        "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
-        "ERROR_ENABLE_PASSWORD": "Enable password required",
-        "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
-        "ERROR_CONFIG_TIMEOUT": "Timeout entering config mode",
-        "ERROR_INTERFACE_TIMEOUT": "Timeout entering interface config",
-        "ERROR_INVALID_IP": "Invalid IP address or netmask",
-        "ERROR_IP_CONFIG": "Failed to configure IP address",
-        "ERROR_INVALID_GATEWAY": "Invalid gateway address",
-        "ERROR_GATEWAY_CONFIG": "Failed to configure gateway",
-        "ERROR_GATEWAY_TIMEOUT": "Timeout configuring gateway",
-        "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
-    }
-    
-    ssh_errors = {
-        "No route to host": "Connection failed: No route to host",
-        "Connection refused": "Connection refused: SSH service not reachable",
-        "Connection timed out": "Connection timeout: Host not responding",
-        "Host is unreachable": "Host unreachable",
-        "Permission denied": "Authentication failed: Wrong username or password",
-    }
-    
     combined = stdout + stderr
     
     # Check for our custom error markers first
-    for error_key, error_msg in error_patterns.items():
-        if error_key in combined:
-            return False, error_msg
+    error_match = ERROR_MARKER_RE.search(combined)
+    if error_match:
+        return False, ERROR_MESSAGES[error_match.group(0)]
     
     # Check for raw SSH errors (but only before we started configuring)
     # After IP change, connection drop is expected
-    if "INFO_CHANGING_IP" not in combined:
-        for ssh_error, error_msg in ssh_errors.items():
-            if ssh_error in combined:
-                return False, error_msg
+    changing_ip = "INFO_CHANGING_IP" in combined
+    if not changing_ip:
+        ssh_match = SSH_ERROR_RE.search(combined)
+        if ssh_match:
+            return False, SSH_ERROR_MESSAGES[ssh_match.group(0)]
     
     # Success indicators
-    success_indicators = [
-        "SUCCESS_COMPLETE",
-        "SUCCESS_IP_CHANGED_CONNECTION_DROPPED",
-        "SUCCESS_IP_CHANGED_TIMEOUT",
-        "SUCCESS_CONFIG_SAVED",
-        "SUCCESS_GATEWAY_SAVED",
-    ]
-    
-    for indicator in success_indicators:
-        if indicator in combined:
-            return True, None
+    if SUCCESS_MARKER_RE.search(combined):
+        return True, None
     
     # If we got to the point of changing IP and then lost connection, that's success
-    if "INFO_CHANGING_IP" in combined:
+    if changing_ip:
         # We started the IP change - connection drop is expected
         return True, None
     
@@ -346,58 +400,101 @@ def analyze_output(stdout, stderr):
     return False, "Unknown error - check stdout"
 
 
+# Nothing after these lines changes the outcome, so the script is stopped there
+STOP_MARKERS = ('ERROR_', 'SUCCESS_IP_CHANGED_')
+
+
 def run_expect_script(script_content, timeout=60):
-    """Run an expect script and return the result"""
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.exp', delete=False) as f:
-        f.write(script_content)
-        script_path = f.name
+    """
+    Run an expect script (piped to 'expect -f -', no temp file) and return the result.
     
+    Output is read line by line while the script runs, and the script is stopped
+    at the first STOP_MARKERS line instead of waiting for it to wind down.
+    stderr is merged into stdout, so the returned stderr is always empty.
+    """
+    proc = subprocess.Popen(
+        ['expect', '-f', '-'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        # Decoded once per line; a stray non-UTF-8 byte must not abort the read
+        errors='replace'
+    )
+    # The script fits in the pipe buffer; expect may exit before reading all of it
     try:
-        os.chmod(script_path, 0o700)
-        result = subprocess.run(
-            [script_path],
+        proc.stdin.write(script_content)
+        proc.stdin.close()
+    except OSError:
+        pass
+    
+    # Reading blocks, so the overall timeout is enforced by killing the process
+    deadline = time.monotonic() + timeout
+    killer = threading.Timer(timeout, proc.kill)
+    killer.start()
+    lines = []
+    try:
+        for line in proc.stdout:
+            lines.append(line)
+            if line.startswith(STOP_MARKERS):
+                proc.terminate()
+                break
+        proc.wait()
+    finally:
+        killer.cancel()
+        proc.stdout.close()
+    
+    # Partial output is kept on timeout
+    if time.monotonic() >= deadline:
+        return "".join(lines), "", -1, True
+    return "".join(lines), "", proc.returncode, False
+
+
+def close_ssh_master(host, username, control_path):
+    """Stop a reused SSH master connection; it still points at the old IP"""
+    try:
+        subprocess.run(
+            ['ssh', '-o', f'ControlPath={control_path}', '-O', 'exit', f'{username}@{host}'],
             capture_output=True,
-            text=True,
-            timeout=timeout
+            timeout=10
         )
-        return result.stdout, result.stderr, result.returncode, False
-    except subprocess.TimeoutExpired as e:
-        # Capture partial output from timeout
-        stdout = e.stdout if e.stdout else ""
-        stderr = e.stderr if e.stderr else ""
-        if isinstance(stdout, bytes):
-            stdout = stdout.decode('utf-8', errors='replace')
-        if isinstance(stderr, bytes):
-            stderr = stderr.decode('utf-8', errors='replace')
-        return stdout, stderr, -1, True
-    finally:
-        if os.path.exists(script_path):
-            os.unlink(script_path)
+    except (OSError, subprocess.SubprocessError):
+        pass
+
+
+def measure_ssh_connect_time(ip, port=22, timeout=SSH_PROBE_TIMEOUT):
+    """Return seconds taken by a TCP connect to the SSH port, or None if it fails"""
+    start = time.monotonic()
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return time.monotonic() - start
+    except OSError:
+        return None
+
+
+def get_script_timeout(connect_time):
+    """Per-prompt expect timeout: short on a LAN, longer for slow links"""
+    return int(min(MAX_SCRIPT_TIMEOUT, MIN_SCRIPT_TIMEOUT + 100 * connect_time))
 
 
 def validate_ip_address(ip_string):
-    """Validate IP address format"""
+    """Validate IPv4 address format (the switch CLI has no IPv6 management address)"""
     try:
-        ipaddress.ip_address(ip_string)
+        ipaddress.IPv4Address(ip_string)
         return True
     except ValueError:
         return False
 
 
 def validate_netmask(netmask_string):
-    """Validate netmask format"""
+    """Validate netmask format (dotted quad with contiguous leading 1 bits)"""
     try:
-        # Check if it's a valid IPv4 address format
-        parts = netmask_string.split('.')
-        if len(parts) != 4:
-            return False
-        for part in parts:
-            num = int(part)
-            if num < 0 or num > 255:
-                return False
-        return True
-    except (ValueError, AttributeError):
+        mask = int(ipaddress.IPv4Address(netmask_string))
+    except ValueError:
         return False
+    # Inverted mask must be of the form 0...01...1, e.g. 255.255.255.0 -> 0x000000FF
+    inverted = mask ^ 0xFFFFFFFF
+    return (inverted & (inverted + 1)) == 0
 
 
 def main():
@@ -422,6 +519,8 @@ def main():
     new_gateway = module.params['new_gateway']
     hostname = module.params['hostname']
     
+    module.get_bin_path('expect', required=True)
+    
     # Validate IP addresses
     if not validate_ip_address(current_ip):
         module.fail_json(msg=f"Invalid current_ip: {current_ip}")
@@ -447,17 +546,28 @@ def main():
             }
         )
     
-    # Generate expect script
-    try:
-        script = create_change_ip_script(
-            current_ip, username, password,
-            new_ip, new_netmask, new_gateway, hostname
+    # Fail fast on a dead host instead of waiting out ssh's ConnectTimeout
+    connect_time = measure_ssh_connect_time(current_ip)
+    if connect_time is None:
+        module.fail_json(
+            msg=f"IP change failed: SSH port 22 on {current_ip} not reachable",
+            host=current_ip
         )
-    except Exception as e:
-        module.fail_json(msg=f"Error generating script: {str(e)}")
+    
+    script_timeout = get_script_timeout(connect_time)
+    control_path = os.path.expanduser(CONTROL_PATH)
+    
+    # Generate expect script
+    script = create_change_ip_script(
+        current_ip, username, password,
+        new_ip, new_netmask, new_gateway, hostname, control_path,
+        script_timeout
+    )
     
     # Run script
-    stdout, stderr, returncode, timed_out = run_expect_script(script, timeout=60)
+    # Overall limit keeps the previous 2:1 ratio to the per-prompt timeout
+    stdout, stderr, returncode, timed_out = run_expect_script(script, timeout=2 * script_timeout)
+    close_ssh_master(current_ip, username, control_path)
     
     # Analyze output
     success, error_msg = analyze_output(stdout, stderr)
@@ -28,8 +28,15 @@ Beispiel:
 
 from ansible.module_utils.basic import AnsibleModule
 import subprocess
-import tempfile
 import os
+import re
+import socket
+import string
+import threading
+import time
+
+# Seconds to wait for the Telnet port before giving up without starting expect
+TELNET_PROBE_TIMEOUT = 5
 
 DOCUMENTATION = r'''
 module: tp_link_initial_setup
@@ -89,232 +96,277 @@ EXAMPLES = r'''
 '''
 
 
-def create_initial_setup_script(default_ip, default_user, default_password, 
-                                 new_password, enable_ssh, hostname):
-    """Generate expect script for initial switch setup via Telnet"""
-    
-    script = f'''#!/usr/bin/expect -f
-set timeout 30
+# Parsed once at import; create_initial_setup_script() only substitutes the values.
+# The passwords are not part of the script: expect reads them from its environment
+# (script_env()), so they need no Tcl quoting and never appear in the script text.
+INITIAL_SETUP_SCRIPT_TEMPLATE = string.Template(r'''set timeout 30
 log_user 1
 
 # === CONNECTION PHASE ===
-spawn telnet {default_ip}
+spawn telnet ${default_ip}
 
-expect {{
-    "Connection refused" {{
-        puts "ERROR_CONNECTION_REFUSED: Telnet port closed on {default_ip}"
+expect {
+    "Connection refused" {
+        puts "ERROR_CONNECTION_REFUSED: Telnet port closed on ${default_ip}"
         exit 1
-    }}
-    "No route to host" {{
-        puts "ERROR_CONNECTION_FAILED: No route to {default_ip}"
+    }
+    "No route to host" {
+        puts "ERROR_CONNECTION_FAILED: No route to ${default_ip}"
         exit 1
-    }}
-    "Unable to connect" {{
-        puts "ERROR_CONNECTION_FAILED: Unable to connect to {default_ip}"
+    }
+    "Unable to connect" {
+        puts "ERROR_CONNECTION_FAILED: Unable to connect to ${default_ip}"
         exit 1
-    }}
-    "Connection timed out" {{
-        puts "ERROR_CONNECTION_TIMEOUT: Connection to {default_ip} timed out"
+    }
+    "Connection timed out" {
+        puts "ERROR_CONNECTION_TIMEOUT: Connection to ${default_ip} timed out"
         exit 1
-    }}
-    "Network is unreachable" {{
+    }
+    "Network is unreachable" {
         puts "ERROR_HOST_UNREACHABLE: Network is unreachable"
         exit 1
-    }}
-    "User:" {{
-        send "{default_user}\\r"
-    }}
-    timeout {{
-        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to {default_ip}"
+    }
+    "User:" {
+        send "${default_user}\r"
+    }
+    timeout {
+        puts "ERROR_CONNECTION_TIMEOUT: Timeout connecting to ${default_ip}"
         exit 1
-    }}
-}}
+    }
+}
 
 # === LOGIN PHASE ===
 expect "Password:"
-send "{default_password}\\r"
+send "$$env(TP_DEFAULT_PASSWORD)\r"
 
 # === CHECK LOGIN RESULT ===
 # Wait for either:
 # - "Change now?" = Factory reset, needs password change
 # - "Login invalid" = Password already changed (switch configured)
 # - hostname prompt = Already logged in (password is still default but no change prompt)
-expect {{
-    "Change now?" {{
+expect {
+    "Change now?" {
         # Factory-reset switch - password change required
         puts "INFO_FACTORY_RESET: Switch requires password change"
-        send "Y\\r"
-    }}
-    "Login invalid" {{
+        send "Y\r"
+    }
+    "Login invalid" {
         # Password already changed - switch is already configured
         puts "ERROR_ALREADY_CONFIGURED: Switch password already changed - not a factory-reset switch"
         exit 2
-    }}
-    "invalid" {{
+    }
+    "invalid" {
         # Alternative invalid message
         puts "ERROR_ALREADY_CONFIGURED: Switch password already changed - not a factory-reset switch"
         exit 2
-    }}
-    "{hostname}>" {{
+    }
+    "${hostname}>" {
         # Logged in without password change prompt - unusual but handle it
         puts "INFO_ALREADY_LOGGED_IN: Switch accepted default password without change prompt"
-        # Continue to enable SSH if requested
-        send "enable\\r"
-        expect "{hostname}#"
-        send "configure\\r"
-        expect "{hostname}(config)#"
-'''
-
-    if enable_ssh:
-        script += f'''
-        send "ip ssh server\\r"
-        expect "{hostname}(config)#"
-'''
-
-    script += f'''
-        send "exit\\r"
-        expect "{hostname}#"
-        send "copy running-config startup-config\\r"
-        expect {{
-            "Saving user config OK!" {{
+        # Continue to enable SSH if requested - no error checks on this path, so the
+        # whole sequence goes out in one send and the prompts are consumed in order
+        send "enable\rconfigure\r${ssh_command}exit\rcopy running-config startup-config\r"
+        expect "${hostname}#"
+        expect "${hostname}(config)#"
+${login_ssh_expect}        expect "${hostname}#"
+        expect {
+            "Saving user config OK!" {
                 puts "SUCCESS_CONFIG_SAVED"
-            }}
-            "Succeed" {{
+            }
+            "Succeed" {
                 puts "SUCCESS_CONFIG_SAVED"
-            }}
-            timeout {{
+            }
+            timeout {
                 puts "ERROR_SAVE_TIMEOUT: Timeout saving configuration"
                 exit 1
-            }}
-        }}
-        send "exit\\r"
-        expect "{hostname}>"
-        send "exit\\r"
+            }
+        }
+        send "exit\r"
+        expect "${hostname}>"
+        send "exit\r"
         expect eof
         puts "SUCCESS_COMPLETE"
         exit 0
-    }}
-    "Access denied" {{
+    }
+    "Access denied" {
         puts "ERROR_ALREADY_CONFIGURED: Access denied - switch password already changed"
         exit 2
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_AUTH_TIMEOUT: Timeout after login - password may be incorrect or switch already configured"
         exit 1
-    }}
-}}
+    }
+}
 
 # === PASSWORD CHANGE SEQUENCE ===
 expect "Please enter the new password:"
-send "{new_password}\\r"
+send "$$env(TP_NEW_PASSWORD)\r"
 
 expect "Please confirm new password again:"
-send "{new_password}\\r"
+send "$$env(TP_NEW_PASSWORD)\r"
 
 # Wait for confirmation and press ENTER
-expect {{
-    "Please Press ENTER" {{
-        send "\\r"
-    }}
-    "Password changed" {{
-        send "\\r"
-    }}
-    timeout {{
+expect {
+    "Please Press ENTER" {
+        send "\r"
+    }
+    "Password changed" {
+        send "\r"
+    }
+    timeout {
         puts "ERROR_PASSWORD_CHANGE: Timeout after password change"
         exit 1
-    }}
-}}
+    }
+}
 
 # Wait for prompt after password change
-expect {{
-    "{hostname}>" {{}}
-    timeout {{
+expect {
+    "${hostname}>" {}
+    timeout {
         puts "ERROR_POST_PASSWORD: Timeout waiting for prompt after password change"
         exit 1
-    }}
-}}
+    }
+}
 
 # === ENABLE MODE ===
-send "enable\\r"
-expect {{
-    "{hostname}#" {{}}
-    "Password:" {{
+send "enable\r"
+expect {
+    "${hostname}#" {}
+    "Password:" {
         puts "ERROR_ENABLE_PASSWORD: Enable password required but not supported"
         exit 1
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_ENABLE_TIMEOUT: Timeout entering enable mode"
         exit 1
-    }}
-}}
+    }
+}
 
 # === CONFIGURE MODE ===
-send "configure\\r"
-expect {{
-    "{hostname}(config)#" {{}}
-    timeout {{
+# "ip ssh server" (enable_ssh) is sent along with configure; its prompt is checked below
+send "configure\r${ssh_command}"
+expect {
+    "${hostname}(config)#" {}
+    timeout {
         puts "ERROR_CONFIG_TIMEOUT: Timeout entering config mode"
         exit 1
-    }}
-}}
-'''
+    }
+}
+${ssh_section}
+# === SAVE CONFIG ===
+send "exit\rcopy running-config startup-config\r"
+expect "${hostname}#"
+expect {
+    "Saving user config OK!" {
+        puts "SUCCESS_CONFIG_SAVED"
+    }
+    "Succeed" {
+        puts "SUCCESS_CONFIG_SAVED"
+    }
+    timeout {
+        puts "ERROR_SAVE_TIMEOUT: Timeout saving configuration"
+        exit 1
+    }
+}
 
-    # Enable SSH if requested
-    if enable_ssh:
-        script += f'''
+# === LOGOUT ===
+send "exit\r"
+expect "${hostname}>"
+send "exit\r"
+expect {
+    eof {}
+    "Connection closed" {}
+    timeout {}
+}
+
+puts "SUCCESS_COMPLETE"
+''')
+
+# enable_ssh: command appended to the configure send on both paths
+SSH_COMMAND = r'ip ssh server\r'
+
+# enable_ssh: its prompt when the switch skips the password change prompt
+LOGIN_SSH_EXPECT_TEMPLATE = string.Template(r'''        expect "${hostname}(config)#"
+''')
+
+# enable_ssh: its result on the regular path, after the password change
+ENABLE_SSH_SECTION_TEMPLATE = string.Template(r'''
 # === ENABLE SSH ===
-send "ip ssh server\\r"
-expect {{
-    "{hostname}(config)#" {{}}
-    "Error" {{
+expect {
+    "${hostname}(config)#" {}
+    "Error" {
         puts "ERROR_SSH_ENABLE: Failed to enable SSH"
         exit 1
-    }}
-    "Invalid" {{
+    }
+    "Invalid" {
         puts "ERROR_SSH_ENABLE: Invalid command for SSH activation"
         exit 1
-    }}
-    timeout {{
+    }
+    timeout {
         puts "ERROR_SSH_TIMEOUT: Timeout enabling SSH"
         exit 1
-    }}
-}}
-'''
+    }
+}
+''')
 
-    # Save configuration and exit
-    script += f'''
-# === SAVE CONFIG ===
-send "exit\\r"
-expect "{hostname}#"
 
-send "copy running-config startup-config\\r"
-expect {{
-    "Saving user config OK!" {{
-        puts "SUCCESS_CONFIG_SAVED"
-    }}
-    "Succeed" {{
-        puts "SUCCESS_CONFIG_SAVED"
-    }}
-    timeout {{
-        puts "ERROR_SAVE_TIMEOUT: Timeout saving configuration"
-        exit 1
-    }}
-}}
+def create_initial_setup_script(default_ip, default_user, enable_ssh, hostname):
+    """Generate expect script for initial switch setup via Telnet (passwords come from script_env())"""
+    
+    if enable_ssh:
+        ssh_command = SSH_COMMAND
+        login_ssh_expect = LOGIN_SSH_EXPECT_TEMPLATE.substitute(hostname=hostname)
+        ssh_section = ENABLE_SSH_SECTION_TEMPLATE.substitute(hostname=hostname)
+    else:
+        ssh_command = login_ssh_expect = ssh_section = ''
+    
+    return INITIAL_SETUP_SCRIPT_TEMPLATE.substitute(
+        default_ip=default_ip, default_user=default_user, hostname=hostname,
+        ssh_command=ssh_command, login_ssh_expect=login_ssh_expect, ssh_section=ssh_section
+    )
 
-# === LOGOUT ===
-send "exit\\r"
-expect "{hostname}>"
-send "exit\\r"
-expect {{
-    eof {{}}
-    "Connection closed" {{}}
-    timeout {{}}
-}}
 
-puts "SUCCESS_COMPLETE"
-'''
-    
-    return script
+def script_env(default_password, new_password):
+    """Environment for the expect process, carrying the passwords the script sends"""
+    return dict(os.environ, TP_DEFAULT_PASSWORD=default_password, TP_NEW_PASSWORD=new_password)
+
+
+ERROR_MESSAGES = {
+    "ERROR_CONNECTION_REFUSED": "Connection refused: Telnet port not open",
+    "ERROR_CONNECTION_FAILED": "Connection failed: Host not reachable",
+    "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
+    "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
+    "ERROR_LOGIN_TIMEOUT": "Timeout during login",
+    "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
+    "ERROR_AUTH_TIMEOUT": "Authentication timeout: Password may be incorrect or switch already configured",
+    "ERROR_PASSWORD_CHANGE": "Error during password change",
+    "ERROR_POST_PASSWORD": "Error after password change",
+    "ERROR_ENABLE_PASSWORD": "Enable password required",
+    "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
+    "ERROR_CONFIG_TIMEOUT": "Timeout entering config mode",
+    "ERROR_SSH_ENABLE": "Failed to enable SSH",
+    "ERROR_SSH_TIMEOUT": "Timeout enabling SSH",
+    "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
+}
+
+# Telnet-specific errors in raw output
+TELNET_ERROR_MESSAGES = {
+    "Connection refused": "Connection refused: Telnet service not reachable",
+    "No route to host": "Connection failed: No route to host",
+    "Unable to connect": "Unable to connect",
+    "Connection timed out": "Connection timed out",
+    "Network is unreachable": "Network is unreachable",
+}
+
+SUCCESS_MARKERS = ("SUCCESS_COMPLETE", "SUCCESS_CONFIG_SAVED")
+
+# Our marker for exit code 2, or the switch rejecting the default password
+ALREADY_CONFIGURED_RE = re.compile(r"ERROR_ALREADY_CONFIGURED|login invalid", re.IGNORECASE)
+# One alternation per table: a single pass over the output instead of one scan per marker
+ERROR_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in ERROR_MESSAGES))
+TELNET_ERROR_RE = re.compile("|".join(re.escape(error) for error in TELNET_ERROR_MESSAGES))
+SUCCESS_MARKER_RE = re.compile("|".join(re.escape(marker) for marker in SUCCESS_MARKERS))
+TIMEOUT_RE = re.compile("timeout", re.IGNORECASE)
 
 
 def analyze_output(stdout, stderr, returncode):
@@ -322,57 +374,26 @@ def analyze_output(stdout, stderr, returncode):
     
     combined = stdout + stderr
     
-    # Check for "already configured" - this is a special case (exit code 2)
-    if "ERROR_ALREADY_CONFIGURED" in combined or returncode == 2:
-        return False, "Switch is already configured (password changed) - not a factory-reset switch", True
-    
-    error_patterns = {
-        "ERROR_CONNECTION_REFUSED": "Connection refused: Telnet port not open",
-        "ERROR_CONNECTION_FAILED": "Connection failed: Host not reachable",
-        "ERROR_CONNECTION_TIMEOUT": "Connection timeout: Host not responding",
-        "ERROR_HOST_UNREACHABLE": "Host unreachable: Network problem",
-        "ERROR_LOGIN_TIMEOUT": "Timeout during login",
-        "ERROR_AUTH_FAILED": "Authentication failed: Wrong username or password",
-        "ERROR_AUTH_TIMEOUT": "Authentication timeout: Password may be incorrect or switch already configured",
-        "ERROR_PASSWORD_CHANGE": "Error during password change",
-        "ERROR_POST_PASSWORD": "Error after password change",
-        "ERROR_ENABLE_PASSWORD": "Enable password required",
-        "ERROR_ENABLE_TIMEOUT": "Timeout entering enable mode",
-        "ERROR_CONFIG_TIMEOUT": "Timeout entering config mode",
-        "ERROR_SSH_ENABLE": "Failed to enable SSH",
-        "ERROR_SSH_TIMEOUT": "Timeout enabling SSH",
-        "ERROR_SAVE_TIMEOUT": "Timeout saving configuration",
-    }
-    
-    # Telnet-specific errors in raw output
-    telnet_errors = {
-        "Connection refused": "Connection refused: Telnet service not reachable",
-        "No route to host": "Connection failed: No route to host",
-        "Unable to connect": "Unable to connect",
-        "Connection timed out": "Connection timed out",
-        "Network is unreachable": "Network is unreachable",
-    }
-    
-    # Check for "Login invalid" in raw output (switch already configured)
-    if "Login invalid" in combined or "login invalid" in combined.lower():
+    # Check for "already configured" - this is a special case (exit code 2, or "Login invalid" in raw output)
+    if returncode == 2 or ALREADY_CONFIGURED_RE.search(combined):
         return False, "Switch is already configured (password changed) - not a factory-reset switch", True
     
     # Check for our custom error markers
-    for error_key, error_msg in error_patterns.items():
-        if error_key in combined:
-            return False, error_msg, False
+    error_match = ERROR_MARKER_RE.search(combined)
+    if error_match:
+        return False, ERROR_MESSAGES[error_match.group(0)], False
     
     # Check for raw telnet errors
-    for telnet_error, error_msg in telnet_errors.items():
-        if telnet_error in combined:
-            return False, error_msg, False
+    telnet_match = TELNET_ERROR_RE.search(combined)
+    if telnet_match:
+        return False, TELNET_ERROR_MESSAGES[telnet_match.group(0)], False
     
     # Check for success
-    if "SUCCESS_COMPLETE" in combined or "SUCCESS_CONFIG_SAVED" in combined:
+    if SUCCESS_MARKER_RE.search(combined):
         return True, None, False
     
     # Check for timeout markers
-    if "TIMEOUT" in combined.upper():
+    if TIMEOUT_RE.search(combined):
         return False, "Timeout during configuration", False
     
     # If we got "Saving user config OK!" that's also success
@@ -382,24 +403,64 @@ def analyze_output(stdout, stderr, returncode):
     return False, "Unknown error - check stdout", False
 
 
-def run_expect_script(script_content, timeout=90):
-    """Run an expect script and return the result"""
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.exp', delete=False) as f:
-        f.write(script_content)
-        script_path = f.name
+# Every error marker is followed by exit, so the script is stopped there
+STOP_MARKERS = ('ERROR_',)
+
+
+def run_expect_script(script_content, timeout=90, env=None):
+    """
+    Run an expect script (piped to 'expect -f -', no temp file) and return the result.
     
+    Output is read line by line while the script runs, and the script is stopped
+    at the first STOP_MARKERS line instead of waiting for it to wind down.
+    stderr is merged into stdout, so the returned stderr is always empty.
+    """
+    proc = subprocess.Popen(
+        ['expect', '-f', '-'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        # Decoded once per line; a stray non-UTF-8 byte must not abort the read
+        errors='replace',
+        env=env
+    )
+    # The script fits in the pipe buffer; expect may exit before reading all of it
     try:
-        os.chmod(script_path, 0o700)
-        result = subprocess.run(
-            [script_path],
-            capture_output=True,
-            text=True,
-            timeout=timeout
-        )
-        return result.stdout, result.stderr, result.returncode
+        proc.stdin.write(script_content)
+        proc.stdin.close()
+    except OSError:
+        pass
+    
+    # Reading blocks, so the overall timeout is enforced by killing the process
+    deadline = time.monotonic() + timeout
+    killer = threading.Timer(timeout, proc.kill)
+    killer.start()
+    lines = []
+    try:
+        for line in proc.stdout:
+            lines.append(line)
+            if line.startswith(STOP_MARKERS):
+                proc.terminate()
+                break
+        proc.wait()
     finally:
-        if os.path.exists(script_path):
-            os.unlink(script_path)
+        killer.cancel()
+        proc.stdout.close()
+    
+    # Partial output is kept on timeout
+    if time.monotonic() >= deadline:
+        return "".join(lines), "", -1, True
+    return "".join(lines), "", proc.returncode, False
+
+
+def probe_port(ip, port, timeout=TELNET_PROBE_TIMEOUT):
+    """Return None if a TCP connect to the port succeeds, else the connect error"""
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return None
+    except OSError as e:
+        return e
 
 
 def main():
@@ -422,30 +483,41 @@ def main():
     enable_ssh = module.params['enable_ssh']
     hostname = module.params['hostname']
     
+    module.get_bin_path('expect', required=True)
+    
     # Password validation
     if len(new_password) < 1:
         module.fail_json(msg="new_password must not be empty")
     
+    # Fail fast on an unreachable switch instead of waiting out the expect timeouts
+    probe_error = probe_port(default_ip, 23)
+    if probe_error:
+        module.fail_json(
+            msg=f"Initial setup failed: Telnet port 23 on {default_ip} not reachable: {probe_error}",
+            host=default_ip
+        )
+    
     # Generate expect script
     try:
-        script = create_initial_setup_script(
-            default_ip, default_user, default_password,
-            new_password, enable_ssh, hostname
-        )
+        script = create_initial_setup_script(default_ip, default_user, enable_ssh, hostname)
     except Exception as e:
         module.fail_json(msg=f"Error generating script: {str(e)}")
     
     # Run script
     try:
-        stdout, stderr, returncode = run_expect_script(script, timeout=90)
-    except subprocess.TimeoutExpired:
-        module.fail_json(
-            msg="Total timeout exceeded (90s) - switch not responding",
-            host=default_ip
+        stdout, stderr, returncode, timed_out = run_expect_script(
+            script, timeout=90, env=script_env(default_password, new_password)
         )
     except Exception as e:
         module.fail_json(msg=f"Unexpected error: {str(e)}", host=default_ip)
     
+    if timed_out:
+        module.fail_json(
+            msg="Total timeout exceeded (90s) - switch not responding",
+            host=default_ip,
+            stdout=stdout
+        )
+    
     # Analyze output
     success, error_msg, already_configured = analyze_output(stdout, stderr, returncode)
     